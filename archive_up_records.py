@@ -1,30 +1,48 @@
-import sys, os
+import os
+import json
+import pickle
+import tempfile
+import argparse
 import time, datetime
+import numpy as np
 import pandas as pd
+from timestamps import to_timestamps
+from series_store import SeriesStore, SeriesStoreWriter, is_store, frame_to_series, merge_series, refresh_cache
+from instrument import Logger, Metrics, profile_run
+from run_lock import run_locked
 
 from threading import Timer
 
 g_uprecords_dir = "../Apic"
 g_uprecords_out = "../A"
+g_series_store = None
+g_memory_budget = None
+g_spill_dir = None
+# A parsed snapshot row takes about this many times its CSV text in memory,
+# counting the copies grouping and merging it make
+SPILL_EXPANSION = 8
+
+g_log = Logger('archive.log')
+g_metrics = Metrics('archive')
 
 def write_log(s, verbose=True):
-    if verbose: print(s)
-    with open('archive.log', 'a') as f:
-        print(s, file=f)
+    g_log(s, verbose)
 
-def parse_datetime(row, column, fmt='%Y-%m-%d %H:%M:%S'):
-    dt = row[column]
-    if isinstance(row[column], str):
-        dt = time.mktime(time.strptime(row[column].strip(), fmt))
-    return dt
+def file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
 
-def archive_worker():
-    agg_df = None
+def save_csv(df, file_path):
+    # Full rewrite of one uploader, timed and counted for the run metrics
+    with g_metrics.timer('uid_write'):
+        df.to_csv(file_path, index=False)
+    g_metrics.count('bytes_written', file_size(file_path))
 
-    today = datetime.date.today()
-    first_day = datetime.date(year=today.year, month=today.month, day=1)
-    month = today.month
-    for filename in os.listdir(g_uprecords_dir):
+def manifest_path():
+    return os.path.join(g_series_store or g_uprecords_out, ".manifest.json")
+
+def list_snapshots(month):
+    filenames = []
+    for filename in sorted(os.listdir(g_uprecords_dir)):
         basename, extname = os.path.splitext(filename)
         if extname.lower() != ".csv": continue
 
@@ -34,48 +52,323 @@ def archive_worker():
             continue
 
         if dt.tm_mon < month: continue
+        filenames.append(filename)
+    return filenames
 
-        try:
-            df = pd.read_csv(os.path.join(g_uprecords_dir, filename))
-            df["uid"] = df.apply(lambda row: int(str(row["uid"]).strip()), axis=1)
+def snapshot_stat(filename):
+    st = os.stat(os.path.join(g_uprecords_dir, filename))
+    return {"mtime": st.st_mtime_ns, "size": st.st_size}
 
-            if agg_df is None:
-                agg_df = df
-            else:
-                agg_df = pd.concat((agg_df, df), axis=0)
+def chunk_rows(path):
+    # Rows per chunk so a parsed chunk takes about half the memory budget,
+    # the other half is for its bucket parts. The row length is taken from
+    # the start of the file.
+    with open(path, 'rb') as f:
+        f.readline()
+        sample = f.read(1 << 16)
+    row = max(1.0, len(sample) / max(1, sample.count(b'\n')))
+    return max(1, int(g_memory_budget // (2 * SPILL_EXPANSION * row)))
+
+def read_snapshot(path, rows=None):
+    if rows is None:
+        yield pd.read_csv(path)
+        return
+    with pd.read_csv(path, chunksize=rows) as reader:
+        yield from reader
+
+def iter_snapshots(filenames, failed, chunked=False):
+    # (filename, frame) of the snapshots one at a time, with chunked in
+    # chunks of chunk_rows. Failed ones are appended to `failed`, when
+    # chunked possibly after some of their chunks were yielded.
+    for filename in filenames:
+        path = os.path.join(g_uprecords_dir, filename)
+        try:
+            frames = read_snapshot(path, chunk_rows(path) if chunked else None)
+            while True:
+                with g_metrics.timer('snapshot_read'):
+                    df = next(frames, None)
+                    if df is None:
+                        break
+                    if df["uid"].dtype.kind not in 'iu':
+                        # Only text uids go through Python strings
+                        df["uid"] = df["uid"].astype(str).str.strip().astype(int)
+                yield filename, df
+            g_metrics.count('bytes_read', os.path.getsize(path))
         except Exception as e:
             write_log('Failed to process %s' % filename)
             write_log(e)
+            g_metrics.count('failures', error=type(e).__name__)
+            failed.append(filename)
             continue
 
         write_log('Successfully process %s' % filename)
 
-    if not os.path.exists(g_uprecords_out):
+def load_snapshots(filenames):
+    failed = []
+    frames = [df for _, df in iter_snapshots(filenames, failed)]
+    if not frames:
+        return None, failed
+    return pd.concat(frames, axis=0), failed
+
+def load_manifest(month_key):
+    try:
+        with open(manifest_path(), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("month") != month_key:
+        return None
+    return manifest
+
+def save_manifest(manifest):
+    path = manifest_path()
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def read_header(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.readline().strip().split(',')
+
+def archive_worker(incremental=False):
+    global g_metrics
+    g_metrics = Metrics('archive')
+    start = time.perf_counter()
+    today = datetime.date.today()
+    first_day = datetime.date(year=today.year, month=today.month, day=1)
+    month = today.month
+    month_key = first_day.strftime("%Y-%m")
+
+    if g_series_store is None and not os.path.exists(g_uprecords_out):
         os.mkdir(g_uprecords_out)
 
+    filenames = list_snapshots(month)
+    stats = {filename: snapshot_stat(filename) for filename in filenames}
+
+    manifest = load_manifest(month_key) if incremental else None
+    if g_series_store is not None:
+        if manifest is not None:
+            ingested = manifest["files"]
+            pending = [f for f in filenames if ingested.get(f) != stats[f]]
+            failed = archive_store(pending)
+        else:
+            failed = archive_store(filenames, time.mktime(first_day.timetuple()))
+    elif manifest is not None:
+        failed = archive_incremental(manifest["files"], stats)
+    elif g_memory_budget is not None:
+        failed = archive_partitioned(filenames, first_day)
+    else:
+        failed = archive_full(filenames, first_day)
+    if g_series_store is None:
+        # Parsed once here, mining and prediction read the cache
+        with g_metrics.timer('cache_refresh'):
+            refresh_cache(g_uprecords_out)
+
+    # Every mode records what the series now hold, so a later incremental
+    # run does not append those snapshots again. Snapshots that failed to
+    # load are retried on the next run.
+    for filename in failed:
+        del stats[filename]
+    save_manifest({"month": month_key, "files": stats})
+
+    g_metrics.observe('run', time.perf_counter() - start)
+    g_metrics.count('snapshots', len(filenames))
+    g_metrics.write('archive.prom')
+    g_log.flush()
+
+def merge_uid(uid, section, first_day):
+    # Replaces this month of the uploader's CSV with the snapshot rows
+    file_path = os.path.join(g_uprecords_out, str(uid)+'.csv')
+    if os.path.exists(file_path):
+        write_log("Loading alread existing file: %s" % file_path)
+
+        with g_metrics.timer('uid_read'):
+            df = pd.read_csv(file_path)
+        g_metrics.count('bytes_read', file_size(file_path))
+        timestamp = time.mktime(first_day.timetuple())
+        mask = to_timestamps(df['Time'])
+        df = df.loc[mask < timestamp]
+        df = pd.concat((df, section), axis=0)
+    else:
+        df = section
+    df = df.drop_duplicates(subset="Time", keep="last")
+    write_log("Saving file: %s" % file_path)
+    save_csv(df, file_path)
+
+def archive_full(filenames, first_day):
+    agg_df, failed = load_snapshots(filenames)
+
     if agg_df is not None:
         for uid, section in agg_df.groupby("uid"):
-            file_path = os.path.join(g_uprecords_out, str(uid)+'.csv')
-            if os.path.exists(file_path):
-                write_log("Loading alread existing file: %s" % file_path)
+            merge_uid(uid, section, first_day)
+    return failed
+
+def spill_buckets(filenames):
+    total = sum(os.path.getsize(os.path.join(g_uprecords_dir, f)) for f in filenames)
+    return max(1, -(-total * SPILL_EXPANSION // g_memory_budget))
+
+def common_dtypes(dtypes, new_dtypes):
+    # The dtypes pd.concat would give all frames together: numbers widen,
+    # a column missing from a frame becomes float, anything else object
+    first = not dtypes
+    for c in set(dtypes) | set(new_dtypes):
+        old = dtypes.get(c, None if first else np.dtype(np.float64))
+        new = new_dtypes.get(c, np.dtype(np.float64))
+        if old is None:
+            dtypes[c] = new
+        elif old.kind in 'iuf' and new.kind in 'iuf':
+            dtypes[c] = np.result_type(old, new)
+        elif old != new:
+            dtypes[c] = np.dtype(object)
+    return dtypes
+
+def read_spill(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def archive_partitioned(filenames, first_day):
+    # Out of core archive_full: snapshots are read in chunks and their rows
+    # spilled to on-disk buckets by uid hash, then every bucket is merged on
+    # its own, so memory is bounded by a chunk or the largest bucket.
+    failed = []
+    buckets = spill_buckets(filenames)
+    dtypes, columns = {}, []
+    with tempfile.TemporaryDirectory(prefix='archive-spill-', dir=g_spill_dir) as spill_dir:
+        # The chunks of a snapshot count once it was read to the end, the
+        # parts of one that failed partway are left out of the merge. A
+        # bucket file is only open while a chunk appends to it, there can
+        # be more buckets than the open file limit.
+        spilled = set()
+        current, file_dtypes, file_columns = None, {}, []
+
+        def finish():
+            if current is not None and current not in failed:
+                common_dtypes(dtypes, file_dtypes)
+                columns.extend(c for c in file_columns if c not in columns)
+
+        for filename, df in iter_snapshots(filenames, failed, chunked=True):
+            if filename != current:
+                finish()
+                current, file_dtypes, file_columns = filename, {}, []
+            common_dtypes(file_dtypes, df.dtypes.to_dict())
+            file_columns += [c for c in df.columns if c not in file_columns]
+            for bucket, part in df.groupby(df['uid'] % buckets, sort=False):
+                with open(os.path.join(spill_dir, '%d.pkl' % bucket), 'ab') as f:
+                    pickle.dump((filename, part), f, protocol=pickle.HIGHEST_PROTOCOL)
+                spilled.add(bucket)
+        finish()
+        write_log("Spilled %d snapshots into %d buckets" % (len(filenames) - len(failed), len(spilled)))
+
+        for bucket in sorted(spilled):
+            with g_metrics.timer('bucket_merge'):
+                parts = [part for filename, part in read_spill(os.path.join(spill_dir, '%d.pkl' % bucket))
+                         if filename not in failed]
+                if not parts:
+                    continue
+                agg_df = pd.concat(parts, axis=0)
+                agg_df = agg_df.reindex(columns=columns)
+                for c in columns:
+                    if agg_df[c].dtype != dtypes[c]:
+                        agg_df[c] = agg_df[c].astype(dtypes[c])
+                for uid, section in agg_df.groupby("uid"):
+                    merge_uid(uid, section, first_day)
+    return failed
+
+def archive_incremental(ingested, stats):
+    new_files = [f for f in stats if f not in ingested]
+    changed_files = [f for f in stats if f in ingested and ingested[f] != stats[f]]
+    write_log("Ingesting %d new and %d changed snapshots" % (len(new_files), len(changed_files)))
 
+    # Rows of a snapshot that changed after it was ingested may already be in
+    # the series, those uids are rewritten with the new rows replacing the old
+    # ones (rows missing from the new version are kept). All other rows are
+    # appended, including late snapshots for earlier hours: readers sort the
+    # series by Time.
+    new_df, failed = load_snapshots(new_files)
+    changed_df, changed_failed = load_snapshots(changed_files)
+    failed += changed_failed
+    changed_uids = set() if changed_df is None else set(changed_df["uid"].unique())
+    frames = [df for df in (new_df, changed_df) if df is not None]
+    if not frames:
+        return failed
+    agg_df = pd.concat(frames, axis=0)
+
+    for uid, section in agg_df.groupby("uid"):
+        file_path = os.path.join(g_uprecords_out, str(uid)+'.csv')
+        if not os.path.exists(file_path):
+            write_log("Saving file: %s" % file_path)
+            save_csv(section, file_path)
+            continue
+
+        header = read_header(file_path)
+        if uid in changed_uids or set(header) != set(section.columns):
+            with g_metrics.timer('uid_read'):
                 df = pd.read_csv(file_path)
-                timestamp = time.mktime(first_day.timetuple())
-                mask = df.apply(parse_datetime, axis=1, args=('Time',))
-                df = df.loc[mask < timestamp]
-                df = pd.concat((df, section), axis=0)
-                df.drop_duplicates(subset="Time")
-            else:
-                df = section
+            g_metrics.count('bytes_read', file_size(file_path))
+            df = pd.concat((df, section), axis=0)
+            df = df.drop_duplicates(subset="Time", keep="last")
             write_log("Saving file: %s" % file_path)
-            df.to_csv(file_path, index=False)
+            save_csv(df, file_path)
+        else:
+            # Rows whose Time the file already holds were appended by a run
+            # that died before it saved the manifest
+            with g_metrics.timer('uid_read'):
+                times = pd.read_csv(file_path, usecols=['Time'])['Time']
+            section = section.drop_duplicates(subset="Time", keep="last")
+            section = section.loc[~np.isin(to_timestamps(section['Time']), to_timestamps(times))]
+            if section.shape[0] == 0:
+                continue
+            write_log("Appending to file: %s" % file_path)
+            size = file_size(file_path)
+            with g_metrics.timer('uid_write'):
+                with open(file_path, 'a', encoding='utf-8', newline='') as f:
+                    section[header].to_csv(f, index=False, header=False)
+            g_metrics.count('bytes_written', file_size(file_path) - size)
+    return failed
+
+def archive_store(filenames, month_start=None):
+    # Rewrites the series store with the snapshot rows merged in. Given
+    # month_start, uploaders found in the snapshots drop their rows from that
+    # point on first, like archive_full does for the CSV files.
+    agg_df, failed = load_snapshots(filenames)
+    if agg_df is None:
+        return failed
+
+    sections = {uid: frame_to_series(section) for uid, section in agg_df.groupby("uid")}
+    store = SeriesStore(g_series_store) if is_store(g_series_store) else None
+    uids = set(sections)
+    if store is not None:
+        uids.update(store.uids())
+
+    with g_metrics.timer('store_write'), SeriesStoreWriter(g_series_store) as writer:
+        for uid in sorted(uids):
+            parts = []
+            if store is not None and uid in store:
+                old = store.read(uid)
+                if month_start is not None and uid in sections:
+                    mask = old['Time'] < month_start
+                    old = {c: values[mask] for c, values in old.items()}
+                parts.append(old)
+            if uid in sections:
+                parts.append(sections[uid])
+            writer.append(uid, merge_series(parts))
+    write_log("Saved %d uploaders to %s" % (len(uids), g_series_store))
+    return failed
 
 g_invoke_first = False
+g_incremental = False
 
 def on_timeout():
     global g_invoke_first
     if g_invoke_first:
-        archive_worker()
+        run_locked(lambda: archive_worker(incremental=g_incremental), write_log)
     g_invoke_first = True
 
     now = datetime.datetime.now()
@@ -87,15 +380,38 @@ def on_timeout():
         next_time = now.replace(hour=start_hour, minute=0, second=0)
     interval = (next_time-now).seconds
     write_log("Next execution %d seconds later" % interval)
+    g_log.flush()
 
     timer = Timer(interval, on_timeout)
     timer.start()
 
 
-if __name__ == "__main__":
-    # Run immediately first
-    if len(sys.argv) >= 2 and sys.argv[1] == '--now':
-        g_invoke_first = True
+def main(argv=None, prog=None):
+    global g_invoke_first, g_incremental, g_series_store, g_spill_dir, g_memory_budget
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('--now', action='store_true', help='run immediately first')
+    parser.add_argument('--incremental', action='store_true', help='only ingest new or changed snapshots')
+    parser.add_argument('--store', help='archive into this series store instead of ../A')
+    parser.add_argument('--memory-budget', type=int, help='archive out of core within about this many MB')
+    parser.add_argument('--spill-dir', help='directory for the spill buckets of --memory-budget')
+    parser.add_argument('--profile', help='run once under cProfile and dump the stats to this file')
+    args = parser.parse_args(argv)
+    if args.memory_budget and (args.incremental or args.store):
+        # Those modes load the pending snapshots whole
+        parser.error('--memory-budget only applies to a full archive into ../A')
+
+    g_invoke_first = args.now
+    g_incremental = args.incremental
+    g_series_store = args.store
+    g_spill_dir = args.spill_dir
+    if args.memory_budget:
+        g_memory_budget = args.memory_budget << 20
 
+    if args.profile:
+        profile_run(lambda: archive_worker(incremental=g_incremental), args.profile)
+        return
     on_timeout()
 
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import os
+import time
+import json
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from instrument import Logger, Metrics
+
+# Avatar URLs of the uploaders, fetched in a stage of their own instead of
+# inside compute_index. Threads share one pooled session, requests are rate
+# limited and retried with exponential backoff. The results are cached on
+# disk keyed by uid:
+#
+# {"<uid>": {"face": url, "etag": etag or null, "fetched": unix time}}
+#
+# Entries younger than the TTL are not requested at all, stale ones are
+# revalidated with If-None-Match and only refetched when they changed.
+
+g_api_url = 'https://api.bilibili.com/x/space/acc/info?mid=%s'
+g_cache_path = 'faces.json'
+g_ttl = 7 * 24 * 60 * 60
+g_workers = 8
+g_rate = 5.0
+g_retries = 3
+g_backoff = 1.0
+g_timeout = 10
+
+g_log = Logger('avatars.log')
+
+def write_log(s, verbose=True):
+    g_log(s, verbose)
+
+
+class RateLimiter:
+    # Spaces requests evenly over all threads, at most `rate` per second
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def make_session(workers):
+    # requests is only imported once something is fetched, export_face only
+    # reads the cache
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def load_faces(path=g_cache_path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_faces(cache, path=g_cache_path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def retry_delay(response, attempt):
+    if response is not None and 'Retry-After' in response.headers:
+        try:
+            return float(response.headers['Retry-After'])
+        except ValueError:
+            pass
+    return g_backoff * 2 ** attempt
+
+
+def fetch_face(session, limiter, uid, entry=None):
+    # Returns (status, entry or error), status is fetched, revalidated or failed
+    import requests
+    headers = {}
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+
+    error = None
+    for attempt in range(g_retries + 1):
+        limiter.wait()
+        response = None
+        try:
+            response = session.get(g_api_url % uid, headers=headers, timeout=g_timeout)
+        except requests.RequestException as e:
+            error = "%s: %s" % (type(e).__name__, e)
+        else:
+            if response.status_code == 304 and entry is not None:
+                return 'revalidated', dict(entry, fetched=time.time())
+            if response.status_code == 200:
+                try:
+                    face = response.json()['data']['face']
+                except Exception as e:
+                    return 'failed', "%s: %s" % (type(e).__name__, e)
+                return 'fetched', {'face': face, 'etag': response.headers.get('ETag'), 'fetched': time.time()}
+            error = "HTTP %d" % response.status_code
+            if response.status_code != 429 and response.status_code < 500:
+                return 'failed', error
+        if attempt < g_retries:
+            time.sleep(retry_delay(response, attempt))
+    return 'failed', error
+
+
+def stale_uids(uids, cache, ttl=g_ttl, now=None):
+    if now is None:
+        now = time.time()
+    stale = []
+    for uid in uids:
+        entry = cache.get(str(uid))
+        if entry is None or now - entry.get('fetched', 0) >= ttl:
+            stale.append(uid)
+    return stale
+
+
+def fetch_avatars(uids, cache_path=None, workers=None, ttl=None, force=False):
+    cache_path = g_cache_path if cache_path is None else cache_path
+    workers = g_workers if workers is None else workers
+    ttl = g_ttl if ttl is None else ttl
+
+    cache = load_faces(cache_path)
+    pending = list(uids) if force else stale_uids(uids, cache, ttl)
+    write_log("Fetching %d of %d avatars" % (len(pending), len(uids)))
+
+    metrics = Metrics('avatars')
+    statuses = Counter()
+    session = make_session(workers)
+    limiter = RateLimiter(g_rate)
+
+    def fetch(uid):
+        start = time.perf_counter()
+        result = fetch_face(session, limiter, uid, cache.get(str(uid)))
+        metrics.observe('uid', time.perf_counter() - start)
+        return uid, result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, (uid, (status, result)) in enumerate(executor.map(fetch, pending)):
+            statuses[status] += 1
+            metrics.count('requests', status=status)
+            if status == 'failed':
+                write_log("Failed to fetch avatar %s: %s" % (uid, result), verbose=False)
+            else:
+                cache[str(uid)] = result
+            if (i + 1) % 500 == 0:
+                save_faces(cache, cache_path)
+    session.close()
+
+    save_faces(cache, cache_path)
+    metrics.write('avatars.prom')
+    write_log("Avatars fetched %d, revalidated %d, failed %d, fresh %d" % (
+        statuses['fetched'], statuses['revalidated'], statuses['failed'], len(uids) - len(pending)))
+    g_log.flush()
+    return statuses
+
+
+def avatar_worker(list_path='../Apic/a.json', force=False):
+    df = pd.read_json(list_path, orient='records', encoding='utf-8')
+    return fetch_avatars(df['uid'].tolist(), force=force)
+
+
+def main(argv=None, prog=None):
+    global g_cache_path, g_api_url, g_ttl, g_workers, g_rate, g_retries
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('--list', default='../Apic/a.json', help='uploader list to fetch the avatars of')
+    parser.add_argument('--cache', default=g_cache_path, help='avatar cache file')
+    parser.add_argument('--api', default=g_api_url, help='API URL with %%s for the uid')
+    parser.add_argument('--ttl', type=float, default=g_ttl / 3600, help='hours before a cached avatar is revalidated')
+    parser.add_argument('--workers', type=int, default=g_workers, help='concurrent requests')
+    parser.add_argument('--rate', type=float, default=g_rate, help='requests per second, 0 for no limit')
+    parser.add_argument('--retries', type=int, default=g_retries)
+    parser.add_argument('--force', action='store_true', help='revalidate every avatar regardless of the TTL')
+    args = parser.parse_args(argv)
+
+    g_cache_path = args.cache
+    g_api_url = args.api
+    g_ttl = args.ttl * 3600
+    g_workers = max(1, args.workers)
+    g_rate = args.rate
+    g_retries = args.retries
+
+    avatar_worker(args.list, args.force)
+
+
+if __name__ == '__main__':
+    main()
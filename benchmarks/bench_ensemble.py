@@ -0,0 +1,78 @@
+import os, sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import predictor
+from forecast import pack_ragged
+
+# predictor.forecast_ensemble end to end: both fields, their percentile
+# bands and the ChannelValue of every path, chunk by chunk as
+# predict_worker consumes it (without writing the files).
+
+
+def make_series(uploaders, seed=0, start=10000, drift=5.0):
+    # A month of three-hourly samples per uploader, ragged lengths
+    rng = np.random.default_rng(seed)
+    Xs, Ys = [], []
+    for length in rng.integers(2, 240, size=uploaders).tolist():
+        X = np.arange(length) * 3.0
+        Y = start + np.cumsum(rng.normal(drift, 20.0, size=length))
+        Xs.append(X)
+        Ys.append(Y)
+    return Xs, Ys
+
+
+def make_info(uploaders, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'uid': np.arange(uploaders) + 1000,
+        'AvgView': rng.random(uploaders) * 1e5 + 100,
+        'AvgScore': rng.random(uploaders) * 1e4,
+        'IncomeYearly': rng.random(uploaders) * 1e6,
+        'ChargesMonthly': rng.integers(0, 200, uploaders).astype(np.float64),
+        'ViewsMonthly': rng.random(uploaders) * 1e6 + 1,
+    })
+
+
+def make_packed(uploaders):
+    packed = {}
+    for field, (seed, start, drift) in (('FanNum', (0, 10000, 5.0)), ('PlayNum', (1, 10**6, 500.0))):
+        Xs, Ys = make_series(uploaders, seed, start, drift)
+        X, offsets = pack_ragged(Xs)
+        Y, _ = pack_ragged(Ys)
+        packed[field] = (X, Y, offsets)
+    return packed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uploaders', type=int, default=1000)
+    parser.add_argument('--paths', type=int, default=1000)
+    parser.add_argument('--steps', type=int, default=24//3 * 7*2)
+    parser.add_argument('--percentiles', default='10,90')
+    parser.add_argument('--memory', type=int, default=256, help='memory budget in MB')
+    args = parser.parse_args()
+
+    predictor.g_steps = args.steps
+    predictor.g_paths = args.paths
+    predictor.g_percentiles = tuple(float(q) for q in args.percentiles.split(',') if q)
+    predictor.g_ensemble_memory = args.memory << 20
+    packed = make_packed(args.uploaders)
+    info = make_info(args.uploaders)
+    rng = np.random.default_rng(0)
+
+    start = time.perf_counter()
+    chunks = 0
+    for _ in predictor.forecast_ensemble(packed, info, rng, 0.0):
+        chunks += 1
+    elapsed = time.perf_counter() - start
+
+    paths = args.uploaders * args.paths
+    print("uploaders:   %d" % args.uploaders)
+    print("paths:       %d per uploader, %d steps, 2 fields" % (args.paths, args.steps))
+    print("chunks:      %d" % chunks)
+    print("elapsed:     %.3fs" % elapsed)
+    print("paths/sec:   %.0f" % (paths / elapsed))
@@ -0,0 +1,99 @@
+import os, sys
+import json
+import time
+import argparse
+import subprocess
+
+# Cold start cost of the pipeline commands. Every sample is a fresh
+# interpreter importing one module (what `pipeline.py <command>` loads), the
+# median wall time is reported together with the slowest imports found by
+# python -X importtime. Results can be saved as a baseline and later runs
+# compared against it, like bench_pipeline.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    'interpreter': 'pass',
+    'pipeline --help': 'import pipeline; pipeline.usage("pipeline.py")',
+    'archive': 'import archive_up_records',
+    'mine': 'import dataminer',
+    'predict': 'import predictor',
+    'export-face': 'import export_face',
+    'schedule': 'import scheduler',
+}
+
+
+def sample(code):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+
+def slowest_imports(code, top):
+    # importtime lines: "import time: self [us] | cumulative | imported package".
+    # Top level packages at any depth, so pandas shows up under dataminer.
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                            check=True, capture_output=True, text=True)
+    own = set(code.replace(';', ' ').split())
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        if '.' in name or name.startswith('_') or name in own or name in ('site', 'encodings'):
+            continue
+        cumulative[name] = max(cumulative.get(name, 0), int(parts[1]) / 1e6)
+    return sorted(((seconds, name) for name, seconds in cumulative.items()), reverse=True)[:top]
+
+
+def run_benchmark(repeat, top):
+    results = {}
+    for name, code in TARGETS.items():
+        samples = sorted(sample(code) for _ in range(repeat))
+        results[name] = {'seconds': samples[len(samples) // 2],
+                         'imports': slowest_imports(code, top) if top else []}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name in baseline:
+            old, new = baseline[name]['seconds'], result['seconds']
+            if old > 0 and new > old * (1 + tolerance):
+                regressions.append((name, old, new))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per target')
+    parser.add_argument('--top', type=int, default=3, help='slowest top level imports to list per target')
+    parser.add_argument('--baseline', help='compare against this baseline file')
+    parser.add_argument('--save-baseline', help='write the results to this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before a regression')
+    args = parser.parse_args()
+
+    results = run_benchmark(max(1, args.repeat), args.top)
+    print("%-16s %10s  %s" % ('target', 'ms', 'slowest imports (cumulative ms)'))
+    for name, result in results.items():
+        imports = ', '.join('%s %.0f' % (module, seconds * 1000) for seconds, module in result['imports'])
+        print("%-16s %10.1f  %s" % (name, result['seconds'] * 1000, imports))
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, old, new in regressions:
+            print("Regression %s: %.1fms -> %.1fms (%+.0f%%)" % (name, old * 1000, new * 1000, (new / old - 1) * 100))
+        if not regressions:
+            print("No regressions against %s" % args.baseline)
+        status = 1 if regressions else 0
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    exit(status)
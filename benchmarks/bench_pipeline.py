@@ -0,0 +1,147 @@
+import os, sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from corpus import generate_corpus
+
+# End to end benchmark on a synthetic corpus. Every stage runs in its own
+# process from <root>/work, so its peak RSS is its own (mining workers are
+# counted through RUSAGE_CHILDREN). Results can be saved as a baseline and
+# later runs compared against it.
+
+STAGES = ('archive', 'mine', 'predict')
+
+
+def run_stage(stage, workers):
+    import archive_up_records, dataminer, predictor
+    quiet = lambda s, verbose=True: None
+    archive_up_records.write_log = dataminer.write_log = predictor.write_log = quiet
+
+    start = time.perf_counter()
+    if stage == 'archive':
+        archive_up_records.archive_worker()
+    elif stage == 'mine':
+        dataminer.g_full = True
+        dataminer.mining_worker(workers=workers)
+    else:
+        predictor.g_seed = 0
+        predictor.predict_worker()
+    seconds = time.perf_counter() - start
+
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    result = {'seconds': seconds, 'peak_rss_mb': rss / 1024}
+    if stage == 'mine':
+        result['sidecar_matches'] = sidecar_matches(dataminer.g_output_path)
+    return result
+
+
+def sidecar_matches(path):
+    # The sidecar is built from the frame rather than by parsing the table,
+    # it has to hold exactly what a parse gives
+    from records_io import read_columns, read_records
+    sidecar, parsed = read_columns(path), read_records(path)
+    return list(sidecar.dtypes.items()) == list(parsed.dtypes.items()) and sidecar.equals(parsed)
+
+
+def run_pipeline(root, uploaders, workers):
+    results = {}
+    for stage in STAGES:
+        fd, result_path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--run-stage', stage,
+                            '--workers', str(workers), '--result', result_path],
+                           cwd=os.path.join(root, 'work'), stdout=subprocess.DEVNULL, check=True)
+            with open(result_path, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+        finally:
+            os.remove(result_path)
+        result['uploaders_per_sec'] = uploaders / result['seconds'] if result['seconds'] else float('inf')
+        results[stage] = result
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        for key in ('seconds', 'peak_rss_mb'):
+            old, new = baseline[stage][key], result[key]
+            if old > 0 and new > old * (1 + tolerance):
+                regressions.append((stage, key, old, new))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uploaders', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--videos', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help='number of mining processes')
+    parser.add_argument('--root', help='generate the corpus here instead of a temporary directory')
+    parser.add_argument('--baseline', help='compare against this baseline file')
+    parser.add_argument('--save-baseline', help='write the results to this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown or growth before a regression')
+    parser.add_argument('--run-stage', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        result = run_stage(args.run_stage, args.workers)
+        with open(args.result, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+        exit()
+
+    config = {'uploaders': args.uploaders, 'days': args.days, 'videos': args.videos,
+              'seed': args.seed, 'workers': args.workers}
+    tmp = None
+    root = args.root
+    if root is None:
+        tmp = tempfile.TemporaryDirectory(prefix='bench_pipeline_')
+        root = tmp.name
+
+    try:
+        start = time.perf_counter()
+        generate_corpus(root, args.uploaders, args.days, args.videos, args.seed)
+        print("corpus:      %d uploaders x %d days x %d videos in %.1fs" % (
+            args.uploaders, args.days, args.videos, time.perf_counter() - start))
+        results = run_pipeline(root, args.uploaders, args.workers)
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    print("%-10s %10s %14s %14s" % ('stage', 'seconds', 'uploaders/s', 'peak RSS MB'))
+    for stage, result in results.items():
+        print("%-10s %10.3f %14.1f %14.1f" % (stage, result['seconds'], result['uploaders_per_sec'], result['peak_rss_mb']))
+    total = sum(result['seconds'] for result in results.values())
+    print("%-10s %10.3f %14.1f" % ('total', total, args.uploaders / total))
+
+    status = 0
+    if not results['mine']['sidecar_matches']:
+        print("The a.json sidecar differs from the parsed table")
+        status = 1
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print("Baseline was recorded with %s" % baseline.get('config'))
+        regressions = compare(results, baseline['stages'], args.tolerance)
+        for stage, key, old, new in regressions:
+            print("Regression %s %s: %.3f -> %.3f (%+.0f%%)" % (stage, key, old, new, (new / old - 1) * 100))
+        if not regressions:
+            print("No regressions against %s" % args.baseline)
+        status = 1 if regressions else 0
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({'config': config, 'stages': results}, f, indent=2)
+
+    exit(status)
@@ -0,0 +1,45 @@
+import os, sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from timestamps import to_timestamps, DATETIME_FORMAT
+
+
+def parse_datetime(row, column, fmt=DATETIME_FORMAT):
+    dt = row[column]
+    if isinstance(row[column], str):
+        dt = time.mktime(time.strptime(row[column].strip(), fmt))
+    return dt
+
+
+def make_series(rows, seed=0):
+    # Three-hourly snapshots like ../A/<uid>.csv, shuffled over a year
+    rng = np.random.default_rng(seed)
+    start = time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1))
+    stamps = start + rng.integers(0, 365*8, size=rows) * 3*60*60
+    return pd.DataFrame({'Time': [time.strftime(DATETIME_FORMAT, time.localtime(t)) for t in stamps.tolist()]})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    df = make_series(args.rows)
+
+    start = time.perf_counter()
+    legacy = df.apply(parse_datetime, axis=1, args=('Time',)).to_numpy(dtype=np.float64)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = to_timestamps(df['Time'])
+    vectorized_time = time.perf_counter() - start
+
+    print("rows:        %d" % args.rows)
+    print("row apply:   %.3fs" % legacy_time)
+    print("vectorized:  %.3fs" % vectorized_time)
+    print("speedup:     %.1fx" % (legacy_time / vectorized_time))
+    print("mismatches:  %d" % np.count_nonzero(legacy != vectorized))
@@ -0,0 +1,60 @@
+import os, sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from predictor import index_uploaders
+
+
+def make_up_list(uploaders, seed=0):
+    # a.json like table, shuffled uids and a few info columns
+    rng = np.random.default_rng(seed)
+    uids = rng.permutation(uploaders) + 1000
+    return pd.DataFrame({
+        'uid': uids,
+        'Name': ['up%d' % uid for uid in uids.tolist()],
+        'AvgView': rng.random(uploaders) * 1e5,
+        'AvgScore': rng.random(uploaders) * 1e4,
+        'IncomeYearly': rng.random(uploaders) * 1e6,
+    })
+
+
+def mask_lookup(up_list, uids):
+    infos = []
+    for uid in uids:
+        up_info = up_list.loc[up_list['uid'] == uid]
+        if up_info.shape[0] == 0:
+            continue
+        infos.append(up_info.iloc[0])
+    return infos
+
+
+def indexed_lookup(up_list, uids):
+    index, up_info = index_uploaders(up_list)
+    positions = index.get_indexer(uids)
+    return up_info.iloc[positions[positions >= 0]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,50000,200000')
+    parser.add_argument('--sample', type=int, default=500, help='mask lookups timed per size, the rest is extrapolated')
+    args = parser.parse_args()
+
+    print("%10s %14s %14s %10s" % ('uploaders', 'mask (s)', 'indexed (s)', 'speedup'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        up_list = make_up_list(size)
+        uids = sorted(up_list['uid'].tolist())
+
+        sample = uids[:min(args.sample, size)]
+        start = time.perf_counter()
+        mask_lookup(up_list, sample)
+        mask_time = (time.perf_counter() - start) * size / len(sample)
+
+        start = time.perf_counter()
+        indexed_lookup(up_list, uids)
+        indexed_time = time.perf_counter() - start
+
+        print("%10d %14.3f %14.4f %9.0fx" % (size, mask_time, indexed_time, mask_time / indexed_time))
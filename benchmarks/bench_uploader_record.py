@@ -0,0 +1,129 @@
+import os, sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from uploader_record import UploaderRecord, UploaderTable, MINED_FIELDS
+
+# The bookkeeping part of the mining loop without any I/O: filling the
+# mined fields of every uploader and assembling the frame, once through a
+# copied pandas Series per uid (how compute_index used to work) and once
+# through UploaderRecord and UploaderTable. Reports the time per uid, and
+# over a traced sample the peak memory and the number of memory blocks each
+# path still holds at the end (tracemalloc counts live blocks, not every
+# allocation made).
+
+
+def make_up_list(uploaders, seed=0):
+    rng = np.random.default_rng(seed)
+    uids = np.arange(uploaders) + 1000
+    return pd.DataFrame({
+        'uid': uids,
+        'Name': ['up%d' % uid for uid in uids.tolist()],
+        'PlayNum': rng.integers(10**3, 10**7, uploaders),
+        'FanNum': rng.integers(10, 10**6, uploaders),
+        'ChargeNum': rng.integers(0, 200, uploaders),
+    })
+
+
+def mined_values(uploaders, seed=1):
+    # What the windows and the history scan yield, as the numpy scalars
+    # compute_index gets from them
+    rng = np.random.default_rng(seed)
+    play = rng.integers(10**3, 10**7, (uploaders, 3))
+    fans = rng.integers(10, 10**6, (uploaders, 2))
+    view = rng.random((uploaders, 4)) * 1e5
+    return [(play[i, 0], play[i, 1], play[i, 2], fans[i, 0], fans[i, 1], view[i]) for i in range(uploaders)]
+
+
+def fill(info, values, month_ago=1.7e9):
+    first, week_ago, now, fans_week_ago, fans_now, view = values
+    info['ViewsFirstDayInMonth'] = first
+    info['ViewsMonthly'] = now - first
+    info['ChargesMonthly'] = 12
+    info['ChargeNum'] = info['ChargesMonthly']
+    info['ViewsWeekAgo'] = week_ago
+    info['ViewsNow'] = now
+    info['ViewsWeekly'] = info['ViewsNow'] - info['ViewsWeekAgo']
+    info['PlayNum'] = info['ViewsNow']
+    info['FansWeekAgo'] = fans_week_ago
+    info['FansNow'] = fans_now
+    info['FanIncWeekly'] = info['FansNow'] - info['FansWeekAgo']
+    info['FanNum'] = info['FansNow']
+    info['RecentSince'] = month_ago
+    info['RecentCount'] = 7
+    info['AvgView'] = view[0]
+    info['AvgScore'] = view[1]
+    info['AvgQuality'] = info['AvgView'] + info['AvgScore']
+    info['AvgDuration'] = view[2]
+    info['TotalCount'] = 10
+    info['Frequency'] = view[3] / info['TotalCount']
+
+
+class ItemRecord(UploaderRecord):
+    # Lets fill() write attributes with the item syntax
+    __slots__ = ()
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+def series_path(up_list, mined):
+    infos = []
+    for (_, row), values in zip(up_list.iterrows(), mined):
+        info = row.copy()
+        fill(info, values)
+        infos.append(info)
+    return pd.DataFrame(infos, index=up_list.index)
+
+
+def record_path(up_list, mined):
+    table = UploaderTable(up_list)
+    for i, (uid, values) in enumerate(zip(up_list['uid'].tolist(), mined)):
+        record = ItemRecord(uid)
+        fill(record, values)
+        table.put(i, record)
+    return table.frame()
+
+
+def measure(function, up_list, mined, trace):
+    start = time.perf_counter()
+    df = function(up_list, mined)
+    seconds = time.perf_counter() - start
+
+    # tracemalloc slows pandas down a lot, so only the first `trace` uids
+    up_list, mined = up_list.iloc[:trace], mined[:trace]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    function(up_list, mined)
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'lineno') if stat.count_diff > 0)
+    return df, seconds, blocks, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='500,2000')
+    parser.add_argument('--trace', type=int, default=100, help='uids run under tracemalloc per size')
+    args = parser.parse_args()
+
+    print("%10s %8s %12s %12s %12s" % ('uploaders', 'path', 'us/uid', 'live blocks', 'peak KB'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        up_list = make_up_list(size)
+        mined = mined_values(size)
+        frames = []
+        for name, function in (('series', series_path), ('record', record_path)):
+            df, seconds, blocks, peak = measure(function, up_list, mined, args.trace)
+            frames.append(df)
+            print("%10d %8s %12.1f %12d %12.1f" % (size, name, seconds / size * 1e6, blocks, peak / 2**10))
+        assert frames[0].to_json(orient='records') == frames[1].to_json(orient='records')
+        assert list(frames[1].columns) == list(up_list.columns) + [f for f in MINED_FIELDS if f not in up_list.columns]
+    print("Blocks and peak are over the first %d uids of each size" % args.trace)
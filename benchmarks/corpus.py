@@ -0,0 +1,136 @@
+import os, shutil
+import json
+import time
+import datetime
+import argparse
+import numpy as np
+
+# Synthetic corpus laid out like production, under <root>:
+#
+# Apic/a.json               uploader list read by dataminer
+# Apic/%m-%d %H.csv         snapshots of the current month, read by archive
+# A/<uid>.csv               series from before this month
+# HistoricalRecords/<uid>.json
+# work/                     working directory the scripts run in
+#
+# Half of the video records use the legacy key names (Aid, Name, Time,
+# Danmaku/DMnum, reply, favorite, coin, like), and the files alternate
+# between one array, arrays merged back to back and one record per line.
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+SNAPSHOT_HOURS = 3
+BLOCK = 1000
+
+LEGACY_KEYS = {
+    'AVNum': 'Aid', 'Topic': 'Name', 'UploadTime': 'Time', 'Comment': 'reply'
+    , 'Save': 'favorite', 'Coin': 'coin', 'Like': 'like'
+}
+
+
+def slot_times(days, now):
+    # Every SNAPSHOT_HOURS over the last `days` days, on the hour
+    end = int(now // 3600 * 3600)
+    count = days * 24 // SNAPSHOT_HOURS
+    return end - np.arange(count)[::-1] * SNAPSHOT_HOURS * 3600
+
+
+def write_series(path, uid, strings, play, fan, charge):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('uid,Time,PlayNum,FanNum,ChargeNum\n')
+        f.writelines('%d,%s,%d,%d,%d\n' % row for row in zip(
+            [uid] * len(strings), strings, play.tolist(), fan.tolist(), charge.tolist()))
+
+
+def video_record(rng, uid, v, upload_time, legacy):
+    record = {
+        'AVNum': uid * 1000 + v, 'Topic': 'video %d of %d' % (v, uid),
+        'UploadTime': time.strftime(DATETIME_FORMAT, time.localtime(upload_time)),
+        'DMNum': int(rng.integers(0, 500)), 'Comment': int(rng.integers(0, 500)),
+        'Save': int(rng.integers(0, 2000)), 'Coin': int(rng.integers(0, 2000)),
+        'Like': int(rng.integers(0, 5000)), 'View': int(rng.integers(100, 10**6)),
+        'Duration': int(rng.integers(30, 3600)),
+    }
+    if legacy:
+        record = {LEGACY_KEYS.get(k, k): value for k, value in record.items()}
+        record[['Danmaku', 'DMnum'][v % 4 // 2]] = record.pop('DMNum')
+    return record
+
+
+def write_videos(path, records, layout):
+    lines = [json.dumps(r, ensure_ascii=False) for r in records]
+    with open(path, 'w', encoding='utf-8') as f:
+        if layout == 0:
+            f.write('[' + ', '.join(lines) + ']')
+        elif layout == 1:
+            half = len(lines) // 2
+            f.write('[' + ', '.join(lines[:half]) + '][' + ', '.join(lines[half:]) + ']')
+        else:
+            f.write(''.join(line + ',\n' for line in lines))
+
+
+def generate_corpus(root, uploaders=1000, days=60, videos=30, seed=0, now=None):
+    if now is None:
+        now = time.time()
+    for name in ('Apic', 'A', 'HistoricalRecords', 'work'):
+        path = os.path.join(root, name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    rng = np.random.default_rng(seed)
+    today = datetime.date.fromtimestamp(now)
+    month_start = time.mktime(datetime.date(today.year, today.month, 1).timetuple())
+    times = slot_times(days, now)
+    strings = [time.strftime(DATETIME_FORMAT, time.localtime(t)) for t in times.tolist()]
+    archived = times < month_start
+    snapshots = [time.strftime('%m-%d %H', time.localtime(t)) for t in times[~archived].tolist()]
+    for name in snapshots:
+        with open(os.path.join(root, 'Apic', name + '.csv'), 'w', encoding='utf-8') as f:
+            f.write('uid,Time,PlayNum,FanNum,ChargeNum\n')
+
+    uids = np.arange(uploaders) + 10000
+    up_list = []
+    for start in range(0, uploaders, BLOCK):
+        block = uids[start:start+BLOCK]
+        count, slots = block.shape[0], times.shape[0]
+        play = rng.integers(10**3, 10**7, size=(count, 1)) + np.cumsum(rng.integers(0, 2000, size=(count, slots)), axis=1)
+        fan = rng.integers(10, 10**6, size=(count, 1)) + np.cumsum(rng.integers(-20, 60, size=(count, slots)), axis=1)
+        charge = np.repeat(rng.integers(0, 200, size=(count, 1)), slots, axis=1)
+
+        for i, uid in enumerate(block.tolist()):
+            if archived.any():
+                write_series(os.path.join(root, 'A', '%d.csv' % uid), uid, [s for s, a in zip(strings, archived) if a],
+                             play[i, archived], fan[i, archived], charge[i, archived])
+            up_list.append({
+                'uid': uid, 'Name': 'up%d' % uid, 'Time': strings[-1],
+                'PlayNum': int(play[i, -1]), 'FanNum': int(fan[i, -1]), 'ChargeNum': int(charge[i, -1]),
+                'Face': 'https://i0.hdslb.com/bfs/face/%d.jpg' % uid,
+            })
+
+            upload_times = np.sort(now - rng.random(videos) * days * 86400)
+            records = [video_record(rng, uid, v, t, legacy=v % 2 == 1) for v, t in enumerate(upload_times.tolist())]
+            write_videos(os.path.join(root, 'HistoricalRecords', '%d.json' % uid), records, uid % 3)
+
+        columns = np.flatnonzero(~archived)
+        for j, name in zip(columns.tolist(), snapshots):
+            with open(os.path.join(root, 'Apic', name + '.csv'), 'a', encoding='utf-8') as f:
+                f.writelines('%d,%s,%d,%d,%d\n' % (uid, strings[j], p, fn, c) for uid, p, fn, c in zip(
+                    block.tolist(), play[:, j].tolist(), fan[:, j].tolist(), charge[:, j].tolist()))
+
+    with open(os.path.join(root, 'Apic', 'a.json'), 'w', encoding='utf-8') as f:
+        json.dump(up_list, f, ensure_ascii=False)
+    return {'uploaders': uploaders, 'days': days, 'videos': videos, 'snapshots': len(snapshots)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root')
+    parser.add_argument('--uploaders', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--videos', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    info = generate_corpus(args.root, args.uploaders, args.days, args.videos, args.seed)
+    print("Generated %d uploaders, %d days, %d videos each, %d snapshots in %.1fs" % (
+        info['uploaders'], info['days'], info['videos'], info['snapshots'], time.perf_counter() - start))
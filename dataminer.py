@@ -1,245 +1,289 @@
-import sys, os, shutil
-import math
+import os
 import time
 import datetime
-import numpy as np
 import pandas as pd
-import requests
-import json
+import pickle
+import hashlib
+import argparse
+import multiprocessing
+from collections import Counter
 from threading import Timer
+from index_engine import apply_indices
+from uploader_record import UploaderRecord, UploaderTable
+from historical_records import scan_historical_json
+from series_store import open_series, SERIES_COLUMNS
+from series_windows import window_stats
+from records_io import write_records, backup, source_stat
+from rank_index import build_rank_index
+from trend_store import append_table
+from instrument import Logger, Metrics, profile_run
+from run_lock import run_locked
+
+g_log = Logger('dataminer.log')
+g_metrics = Metrics('dataminer')
 
 def write_log(s, verbose=True):
-    if verbose: print(s)
-    with open('dataminer.log', 'a') as f:
-        print(s, file=f)
+    g_log(s, verbose)
 
 
-def parse_datetime(row, column, fmt='%Y-%m-%d %H:%M:%S'):
-    dt = row[column]
-    if isinstance(row[column], str):
-        dt = time.mktime(time.strptime(row[column].strip(), fmt))
-    return dt
-
-def parse_int(row, column):
-    return int(row[column])
-
-
-def parse_float(row, column):
-    return float(row[column])
-
-def fixMergedVideoData(json_buf):
-    replacements = (
-        ('Aid', 'AVNum'), ('Name', 'Topic'), ('Time', 'UploadTime')
-        , ('Danmaku', 'DMNum'), ('DMnum', 'DMNum'), ('reply', 'Comment')
-        , ('favorite', 'Save'), ('coin', 'Coin'), ('like', 'Like')
-    )
-    for origin, to in replacements:
-        json_buf = json_buf.replace('"%s":' % origin, '"%s":' % to)
-    return json_buf
-
-
-def read_historical_json(path):
-    with open(path, 'r', encoding="utf-8") as f:
-        json_buf = f.read()
-        json_buf = fixMergedVideoData(json_buf)
-        lines = [line.strip(' \n\r\t[],') for line in json_buf.split('\n')]
-        json_buf = ','.join([line for line in lines if len(line) != 0])
-        json_buf = json_buf.strip(' \t\n\r,')
-        json_buf = '[' + json_buf + ']'
-        # with open('test.json', 'w') as o:
-        #     o.write(json_buf)
-        df = pd.read_json(json_buf, orient='records', encoding='utf-8')
-
-        casts = (
-            ('AVNum', parse_int), ('UploadTime', parse_datetime)
-            , ('DMNum', parse_float), ('Comment', parse_float)
-            , ('Save', parse_float), ('Coin', parse_float)
-            , ('Like', parse_float)
-        )
-        for col, parser in casts:
-            df[col] = df.apply(parser, axis=1, args=(col,))
-        return df
-
 class MiningManager:
     def __init__(self, df):
         self.df = df
         self.iter = 0
+        self.failed = {}
+        self.computed = []
 
     def report(self):
         self.iter += 1
         if self.iter % 150 == 0:         
             write_log("Current progress %d/%d" % (self.iter, self.df.shape[0]))
 
-def mining_worker():
-    df = pd.read_json('../Apic/a.json', orient='records', encoding='utf-8')
-    df.drop('Time', axis=1, inplace=True)
+    def fail(self, uid, error):
+        self.failed[uid] = error
+
+    def summary(self):
+        if not self.failed:
+            return
+        write_log("Failed to compute %d/%d uploaders" % (len(self.failed), self.df.shape[0]))
+        counts = Counter(error.split(':', 1)[0] for error in self.failed.values())
+        for name, count in counts.most_common():
+            write_log("  %s: %d" % (name, count))
+        write_log("Failed uids: %s" % ' '.join(str(uid) for uid in sorted(self.failed)), verbose=False)
+
+g_workers = 1
+g_series_path = '../A'
+g_series = None
+g_chunks_per_worker = 16
+
+g_full = False
+g_output_path = 'a.json'
+g_keep_backups = None
+g_cache_path = 'mining_cache.pkl'
+g_trend_path = 'trends'
+g_windows = None
+CACHE_VERSION = 2
+
+def window_boundaries(today=None):
+    # Start of this month, a week ago and 30 days ago, the ranges compute_index reads
+    if today is None:
+        today = datetime.date.today()
+    first_day = datetime.date(year=today.year, month=today.month, day=1)
+    week_ago = today - datetime.timedelta(days=7)
+    month_ago = today - datetime.timedelta(days=30)
+    return tuple(time.mktime(day.timetuple()) for day in (first_day, week_ago, month_ago))
 
-    mm = MiningManager(df)
+def file_fingerprint(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return '%d:%d' % (st.st_mtime_ns, st.st_size)
+
+def row_hashes(df):
+    # One hash per row of the uploader list, computed column by column
+    return pd.util.hash_pandas_object(df, index=False).tolist()
+
+def input_fingerprint(uid, row_hash, columns, windows):
+    # Everything compute_index reads for one uploader
+    parts = (
+        row_hash, columns, windows, g_series.fingerprint(uid),
+        file_fingerprint(os.path.join('../HistoricalRecords', str(uid)+'.json')),
+    )
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+def load_cache(path):
+    try:
+        with open(path, 'rb') as f:
+            cache = pickle.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        write_log("Ignored unreadable mining cache: %s" % e)
+        return {}
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache['entries']
+
+def save_cache(entries, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'version': CACHE_VERSION, 'entries': entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def mine_uploaders(df, mm, workers=1, cache=None):
+    # cache maps uid to (fingerprint, record, error) from the last run. Rows
+    # whose fingerprint is unchanged reuse it, afterwards it holds exactly
+    # the uids of df so uploaders dropped from the list are evicted.
+    uids = df['uid'].tolist()
+    results = [None] * len(uids)
+    fingerprints = [None] * len(uids)
+    dirty = list(range(len(uids)))
+    if cache is not None:
+        dirty = []
+        columns = tuple(df.columns)
+        for i, row_hash in enumerate(row_hashes(df)):
+            fingerprints[i] = input_fingerprint(uids[i], row_hash, columns, g_windows)
+            cached = cache.get(uids[i])
+            if cached is not None and cached[0] == fingerprints[i]:
+                results[i] = cached[1:] + (None,)
+            else:
+                dirty.append(i)
+        write_log("Reusing %d cached uploaders, computing %d" % (len(uids)-len(dirty), len(dirty)))
+
+    # Workers only get the uid and send back a record of the mined fields
+    mm.computed = [uids[i] for i in dirty]
+    pool = None
+    if workers > 1 and len(dirty) > 1:
+        # Chunked dispatch keeps IPC overhead low, imap keeps the input order
+        chunksize = max(1, len(dirty) // (workers * g_chunks_per_worker))
+        pool = multiprocessing.Pool(workers)
+        computed = pool.imap(compute_index, mm.computed, chunksize=chunksize)
+    else:
+        computed = map(compute_index, mm.computed)
+
+    try:
+        for i, result in zip(dirty, computed):
+            mm.report()
+            results[i] = result
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    table = UploaderTable(df)
+    for i, (record, error, stats) in enumerate(results):
+        if stats is None:
+            g_metrics.count('cache_hits')
+        else:
+            g_metrics.merge(*stats)
+        if error is not None:
+            mm.fail(record.uid, error)
+            g_metrics.count('failures', error=error.split(':', 1)[0])
+        table.put(i, record)
+    g_metrics.count('uploaders', len(results))
+
+    if cache is not None:
+        cache.clear()
+        for uid, fingerprint, (record, error, _) in zip(uids, fingerprints, results):
+            cache[uid] = (fingerprint, record, error)
+    return table.frame()
+
+def mining_worker(workers=None):
+    if workers is None:
+        workers = g_workers
+
+    global g_series, g_windows, g_metrics
+    g_metrics = Metrics('dataminer')
+
+    with g_metrics.timer('stage', step='read_list'):
+        df = pd.read_json('../Apic/a.json', orient='records', encoding='utf-8')
+        df.drop('Time', axis=1, inplace=True)
 
-    if os.path.exists('a.json'):
-        now = datetime.datetime.now().timetuple()
-        dstname = time.strftime("%Y-%m-%d-%H-%M-%S.json")
-        shutil.copyfile('a.json', dstname)
+    mm = MiningManager(df)
 
-    df = df.apply(compute_index, axis=1, args=(mm,))
-    s = df.to_json(orient='records')
-    with open('a.json', 'w', encoding='utf-8') as f:
-        f.write(s)
+    # Opened before the pool starts so forked workers share the mapping
+    g_series = open_series(g_series_path)
+    g_windows = window_boundaries()
+    cache = {} if g_full else load_cache(g_cache_path)
+
+    previous = source_stat(g_output_path) if os.path.exists(g_output_path) else None
+    backup(g_output_path, keep=g_keep_backups)
+
+    with g_metrics.timer('stage', step='mine'):
+        df = mine_uploaders(df, mm, workers, cache)
+        save_cache(cache, g_cache_path)
+    with g_metrics.timer('stage', step='indices'):
+        df = apply_indices(df, failed=df['uid'].isin(list(mm.failed)).to_numpy())
+    mm.summary()
+    with g_metrics.timer('stage', step='write'):
+        write_records(g_output_path, df, sidecar=True)
+    g_metrics.count('bytes_written', os.path.getsize(g_output_path))
+    with g_metrics.timer('stage', step='rank'):
+        # Only the re-mined uids move unless this was a full run
+        ranked = build_rank_index(g_output_path, changed=None if g_full else mm.computed, previous=previous)
+    g_metrics.count('ranked_uploaders', ranked)
+    with g_metrics.timer('stage', step='trends'):
+        append_table(g_output_path, g_trend_path)
     # with open('debug.log', 'a', encoding='utf-8') as f:
     #     print(df.dtypes, file=f)
     #     print(df.columns, file=f)
     #     print(df.head().to_string(), file=f)
     now = datetime.datetime.now().timetuple()
     write_log("Finished mining at %s" % time.strftime("%Y-%m-%d %H:%M:%S", now))
+    g_metrics.write('dataminer.prom')
+    g_log.flush()
 
-def compute_index(info, mm):
-    info = info.copy()
+def compute_index(uid):
+    # Returns the mined record, the error if any, and the timings and
+    # counters of this uid for the run metrics (computed in a pool worker)
+    info = UploaderRecord(uid)
+    error = None
+    timings, counters = {}, {}
+    start = time.perf_counter()
 
-    uid = info['uid']
     write_log("Computing uid: %d" % uid, verbose=True)
 
-    mm.report()
-
     try:
         #######################################################################
 
-        csv_path = os.path.join('../A', str(uid)+'.csv')
-
-        df = pd.read_csv(csv_path)
-        df['Time'] = df.apply(parse_datetime, axis=1, args=('Time',))
-        df.sort_values('Time', axis=0, inplace=True, ascending=True)
-
-        today = datetime.date.today()
-        first_day = datetime.date(year=today.year, month=today.month, day=1)
-        timestamp = time.mktime(first_day.timetuple())
-        this_month = df.loc[df['Time'] > timestamp, :]
-        if not this_month.empty:
-            first_day_row = this_month.iloc[0, :]
-            this_day_row = this_month.iloc[-1, :]
-
-            info['ViewsFirstDayInMonth'] = first_day_row['PlayNum']
-            info['ViewsMonthly'] = this_day_row['PlayNum'] - first_day_row['PlayNum']
-            info['ChargesMonthly'] = this_day_row['ChargeNum']
-            info['ChargeNum'] = info['ChargesMonthly']
-
-        today = datetime.date.today()
-        week_ago = today - datetime.timedelta(days=7)
-        timestamp = time.mktime(week_ago.timetuple())
-        this_week = df.loc[df['Time'] > timestamp, :]
-        if not this_week.empty:
-            week_ago_row = this_week.iloc[0, :]
-            this_day_row = this_week.iloc[-1, :]
-
-            info['ViewsWeekAgo'] = week_ago_row['PlayNum']
-            info['ViewsNow'] = this_day_row['PlayNum']
-            info['ViewsWeekly'] = info['ViewsNow'] - info['ViewsWeekAgo']
-            info['PlayNum'] = info['ViewsNow']
-
-            info['FansWeekAgo'] = week_ago_row['FanNum']
-            info['FansNow'] = this_day_row['FanNum']
-            info['FanIncWeekly'] = info['FansNow'] - info['FansWeekAgo']
-            info['FanNum'] = info['FansNow']
+        month_start, week_ago, month_ago = g_windows or window_boundaries()
+        t = time.perf_counter()
+        series = g_series.read(uid)
+        timings['series_read'] = time.perf_counter() - t
+        counters['series_bytes_read'] = sum(values.nbytes for values in series.values())
+
+        t = time.perf_counter()
+        windows = window_stats(series, {'month': month_start, 'week': week_ago}, SERIES_COLUMNS[1:])
+        timings['windows'] = time.perf_counter() - t
+
+        this_month = windows['month']
+        if this_month['count']:
+            first_day_row = this_month['first']
+            this_day_row = this_month['last']
+
+            info.ViewsFirstDayInMonth = first_day_row['PlayNum']
+            info.ViewsMonthly = this_month['delta']['PlayNum']
+            info.ChargesMonthly = this_day_row['ChargeNum']
+            info.ChargeNum = info.ChargesMonthly
+
+        this_week = windows['week']
+        if this_week['count']:
+            week_ago_row = this_week['first']
+            this_day_row = this_week['last']
+
+            info.ViewsWeekAgo = week_ago_row['PlayNum']
+            info.ViewsNow = this_day_row['PlayNum']
+            info.ViewsWeekly = info.ViewsNow - info.ViewsWeekAgo
+            info.PlayNum = info.ViewsNow
+
+            info.FansWeekAgo = week_ago_row['FanNum']
+            info.FansNow = this_day_row['FanNum']
+            info.FanIncWeekly = info.FansNow - info.FansWeekAgo
+            info.FanNum = info.FansNow
 
         #######################################################################
 
+        # Last 10 videos, sorted by UploadTime
         json_path = os.path.join('../HistoricalRecords', str(uid)+'.json')
-        df = read_historical_json(json_path)
-        df.sort_values('UploadTime', axis=0, inplace=True, ascending=True)
-
-        today = datetime.date.today()
-        month_ago = today - datetime.timedelta(days=30)
-        timestamp = time.mktime(month_ago.timetuple())
-        info['RecentSince'] = timestamp
-        info['RecentCount'] = df.loc[df['UploadTime'] >= timestamp, :].shape[0]
-
-        # Last 10 videos
-        df = df.tail(n=10)
-        df['Score'] = df.apply(lambda v: v['Like'] + 3 *
-                                v['Coin'] + 5*v['Save'], axis=1)
+        t = time.perf_counter()
+        df, recent_count = scan_historical_json(json_path, tail=10, since=month_ago)
+        timings['history_parse'] = time.perf_counter() - t
+        counters['history_bytes_read'] = os.path.getsize(json_path)
+        info.RecentSince = month_ago
+        info.RecentCount = recent_count
+
+        df['Score'] = df['Like'] + 3*df['Coin'] + 5*df['Save']
         if 'View' not in df.columns: df['View'] = 0
-        info['AvgView'] = df['View'].mean()
-        info['AvgScore'] = df['Score'].mean()
-        info['AvgQuality'] = info['AvgView'] + info['AvgScore']
-        info['AvgDuration'] = df['Duration'].mean()
-        info['TotalCount'] = df.shape[0]
+        info.AvgView = df['View'].mean()
+        info.AvgScore = df['Score'].mean()
+        info.AvgQuality = info.AvgView + info.AvgScore
+        info.AvgDuration = df['Duration'].mean()
+        info.TotalCount = df.shape[0]
 
         first_day = datetime.datetime.fromtimestamp(df['UploadTime'].min())
         last_day = datetime.datetime.fromtimestamp(df['UploadTime'].max())
         days_escaped = (last_day-first_day).days
-        info['Frequency'] = days_escaped / info['TotalCount']
-
-        #######################################################################
-
-        try:
-            L4, L3, O4, N4, P4 = info['ViewsNow'], info['ViewsWeekAgo'], info['AvgView'], info['AvgQuality'], info['RecentCount']
-            info['WorkIndex'] = ((N4**1.1 + (L4-L3)/10) * (N4-O4) / O4 * P4 / 30) ** 0.65 / 10
-        except:
-            info['WorkIndex'] = float('Nan')
-        if isinstance(info['WorkIndex'], complex):
-            info['WorkIndex'] = float('Nan')
-
-        K3, K4 = info['FansWeekAgo'], info['FansNow']
-        try:
-            info['FanIncPercentage'] = (K4 - K3) / K3
-        except:
-            info['FanIncPercentage'] = float('Nan')
-        if isinstance(info['FanIncPercentage'], complex):
-            info['FanIncPercentage'] = float('Nan')
-        try:
-            info['FanIncIndex'] = ((K4 - K3) * info['FanIncPercentage']) ** 0.75 * (1 if K4 > K3 else -1)
-        except:
-            info['FanIncIndex'] = float('Nan')
-        if isinstance(info['FanIncIndex'], complex):
-            info['FanIncIndex'] = float('Nan')
-
-
-        '''
-        （(87 % * 5/1000 + 13 % * 15/1000 * K) * B * S * 30/2）* 3.49 + K * N*ln（N）/ 2
-        s = 30-7天发布视频数
-        B = 平均视频播放量
-        K = （两次根号下月充电/播放比）* 100
-        N = 粉丝数*根号下【（粉丝量/平均视频播放量）* 2 *（平均赞赏/平均播放比）】
-
-        (87 % * 5/1000 + 13 % * 15/1000 * K) * B * S * 30
-        这个是频道每年收入
-
-        平均视频收入是
-        (87 % * 5/1000 + 13 % * 15/1000 * K) * B
-        '''
-
-        try:
-            S3, R4, K4, L4, L3 = info['WorkIndex'], info['FanIncIndex'], info['FansNow'], info['ViewsNow'], info['ViewsWeekAgo']
-            info['SummaryIndex'] = (S3+R4)*(K4/1000+(L4-L3)/10000) ** 0.7 / 1000
-        except:
-            info['SummaryIndex'] = float('Nan')
-        if isinstance(info['SummaryIndex'], complex):
-            info['SummaryIndex'] = float('Nan')
-
-        S = info['RecentCount']
-        B = info['AvgView']
-        K = (info['ChargesMonthly']/info['ViewsMonthly']) ** 0.5 * 100
-        N = info['FanNum'] * (info['FanNum']/info['AvgView'] * 2 * (info['AvgScore']/info['AvgView'])) ** 0.5
-        try:
-            info['IncomeYearly'] = ((0.87 * 5/1000 + 0.13 * 15/1000 * K) * B * S * 30)
-        except:
-            info['IncomeYearly'] = float('Nan')
-        if isinstance(info['IncomeYearly'], complex):
-            info['IncomeYearly'] = float('Nan')
-
-        try:
-            info['IncomePerVideo'] = info['IncomeYearly'] / (info['RecentCount']*30)
-        except:
-            info['IncomePerVideo'] = 0.0
-        if isinstance(info['IncomePerVideo'], complex):
-            info['IncomePerVideo'] = float('Nan')
-
-        try:
-            X = info['IncomeYearly']
-            info['ChannelValue'] = (X/2) * 3.49 + K * N * math.log(N) / 2
-        except:
-            info['ChannelValue'] = float('Nan')
-        if isinstance(info['ChannelValue'], complex):
-            info['ChannelValue'] = float('Nan')
+        info.Frequency = days_escaped / info.TotalCount
 
         #######################################################################
 
@@ -249,17 +293,16 @@ def compute_index(info, mm):
         # except:
         #     info['Face'] = 'Not Found'
     except Exception as e:
-        write_log("Failed to compute: %d" % uid, verbose=True)
-        print(e)
-        pass
+        error = "%s: %s" % (type(e).__name__, e)
 
-    return info
+    timings['uid'] = time.perf_counter() - start
+    return info, error, (counters, timings)
 
 g_invoke_first = False
 def on_timeout():
     global g_invoke_first
     if g_invoke_first:
-        mining_worker()
+        run_locked(mining_worker, write_log)
     g_invoke_first = True
 
     now = datetime.datetime.now()
@@ -271,14 +314,40 @@ def on_timeout():
         next_time = now.replace(hour=start_hour, minute=0, second=0)
     interval = (next_time-now).seconds
     write_log("Next execution %d seconds later" % interval)
+    g_log.flush()
 
     timer = Timer(interval, on_timeout)
     timer.start()
 
-if __name__ == "__main__":
-    # Run immediately first
-    if len(sys.argv) >= 2 and sys.argv[1] == '--now':
-        g_invoke_first = True
-
+def main(argv=None, prog=None):
+    global g_invoke_first, g_workers, g_full, g_keep_backups, g_output_path, g_series_path, g_trend_path
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('--now', action='store_true', help='run immediately first')
+    parser.add_argument('--workers', type=int, default=1, help='number of mining processes')
+    parser.add_argument('--store', help='read the time series from this series store instead of ../A')
+    parser.add_argument('--full', action='store_true', help='recompute every uploader instead of reusing the mining cache')
+    parser.add_argument('--jsonl', action='store_true', help='write a.jsonl with one uploader per line instead of a.json')
+    parser.add_argument('--profile', help='run once under cProfile and dump the stats to this file')
+    parser.add_argument('--keep-backups', type=int, help='only keep this many timestamped backups of the previous output')
+    parser.add_argument('--trends', help='append the run to this trend store instead of ./trends')
+    args = parser.parse_args(argv)
+
+    g_invoke_first = args.now
+    g_workers = max(1, args.workers)
+    g_full = args.full
+    g_keep_backups = args.keep_backups
+    if args.jsonl:
+        g_output_path = 'a.jsonl'
+    if args.store:
+        g_series_path = args.store
+    if args.trends:
+        g_trend_path = args.trends
+
+    if args.profile:
+        profile_run(mining_worker, args.profile)
+        return
     on_timeout()
 
+
+if __name__ == "__main__":
+    main()
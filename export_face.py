@@ -1,20 +1,23 @@
-import sys, os, shutil
-import math
-import time
-import datetime
-import numpy as np
-import pandas as pd
-import requests
-import json
+import argparse
+from records_io import read_columns, write_records
+from avatars import load_faces, g_cache_path
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        exit()
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('records', help='mined uploaders, a.json')
+    parser.add_argument('cache', nargs='?', default=g_cache_path, help='avatar cache filled by avatars.py')
+    args = parser.parse_args(argv)
 
-    df = pd.read_json(sys.argv[1], orient='records', encoding='utf-8')
+    # Avatars come from the cache filled by avatars.py, a Face column of the
+    # records is only used for uploaders missing from it
+    df = read_columns(args.records, ['uid', 'Face'])
+    faces = load_faces(args.cache)
+    fallback = df['Face'].tolist() if 'Face' in df.columns else ['Not Found'] * df.shape[0]
+    df['Face'] = [faces[str(uid)]['face'] if str(uid) in faces else face
+                  for uid, face in zip(df['uid'].tolist(), fallback)]
     df = df.loc[:, ['uid', 'Face']]
-    s = df.to_json(orient='records')
-    with open('face.json', 'w', encoding='utf-8') as f:
-        f.write(s)
+    write_records('face.json', df)
     print("Finished exporting.")
-    
\ No newline at end of file
+
+if __name__ == '__main__':
+    main()
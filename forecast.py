@@ -0,0 +1,162 @@
+import numpy as np
+
+# Random-walk forecasts for many uploaders at once. The ragged input series
+# are packed back to back into flat arrays with row offsets (offsets[i] to
+# offsets[i+1] is uploader i), every forecast is a row of a 2D array.
+
+
+def pack_ragged(arrays):
+    lengths = np.array([a.shape[0] for a in arrays], dtype=np.int64)
+    offsets = np.zeros(lengths.shape[0]+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if len(arrays) == 0:
+        return np.empty(0), offsets
+    return np.concatenate([np.asarray(a, dtype=np.float64) for a in arrays]), offsets
+
+
+def _segment_diff(values, offsets):
+    # np.diff inside every segment, a segment of length L becomes L-1 long
+    lengths = np.diff(offsets)
+    segment = np.repeat(np.arange(lengths.shape[0]), lengths)
+    keep = segment[1:] == segment[:-1]
+    new_offsets = np.zeros_like(offsets)
+    np.cumsum(np.maximum(lengths-1, 0), out=new_offsets[1:])
+    return np.diff(values)[keep], new_offsets
+
+
+def _sample_index(u, length):
+    return np.minimum((u * length).astype(np.int64), np.maximum(length-1, 0))
+
+
+def slice_ragged(values, offsets, start, stop):
+    return values[offsets[start]:offsets[stop]], offsets[start:stop+1] - offsets[start]
+
+
+def draw_walk(rng, count, steps, noise=0.5, paths=None):
+    # Uniforms pick the sampled derivative, normals are the multiplicative noise
+    shape = (count, steps) if paths is None else (count, paths, steps)
+    u = rng.random(shape)
+    z = rng.normal(loc=1.0, scale=noise, size=shape)
+    return u, z
+
+
+def random_walk_batch(X, Y, offsets, steps, stride=1, n=1, noise=0.5, rng=None, draws=None, paths=None):
+    # Forecasts are (uploaders, steps), or (uploaders, paths, steps) when
+    # simulating several paths per uploader. X_ is always (uploaders, steps).
+    lengths = np.diff(offsets)
+    count = lengths.shape[0]
+    valid = lengths > n
+
+    derivatives = [(Y, offsets)]
+    dX, _ = _segment_diff(X, offsets)
+    for i in range(n):
+        dY, d_offsets = _segment_diff(*derivatives[-1])
+        if i == 0:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dY = dY / dX
+        derivatives.append((dY, d_offsets))
+
+    if draws is None:
+        draws = draw_walk(np.random.default_rng() if rng is None else rng, count, steps, noise, paths)
+    u, z = draws
+    extra = (np.newaxis,) * (u.ndim - 1)
+
+    values, d_offsets = derivatives.pop()
+    d_lengths = np.diff(d_offsets)
+    index = d_offsets[:-1][(slice(None),) + extra] + _sample_index(u, d_lengths[(slice(None),) + extra])
+    Y_ = np.full(u.shape, np.nan)
+    Y_[valid] = values[index[valid]]
+    Y_ *= z
+    for i in range(n):
+        last_Y, last_offsets = derivatives.pop()
+        Y_ *= stride
+        ends = last_offsets[1:][valid] - 1
+        Y_[valid, ..., 0] += last_Y[ends][(slice(None),) + extra[1:]]
+        Y_ = np.cumsum(Y_, axis=-1)
+
+    X_ = np.full((count, steps), np.nan)
+    X_[valid] = np.arange(steps) * stride + X[offsets[1:][valid] - 1][:, np.newaxis]
+    return X_, Y_, valid
+
+
+def ensemble_chunk_size(paths, steps, memory_budget):
+    # Draws, paths, the partitioned copy for the percentiles and the derived
+    # ChannelValue paths are alive at the same time, about eight arrays.
+    per_uploader = paths * steps * np.dtype(np.float64).itemsize * 8
+    return max(1, int(memory_budget // per_uploader))
+
+
+def iter_ensemble(X, Y, offsets, steps, paths, stride=1, n=1, noise=0.5, rng=None, memory_budget=256 << 20):
+    # Streams over uploader chunks so only one chunk of paths is in memory
+    if rng is None:
+        rng = np.random.default_rng()
+    count = offsets.shape[0] - 1
+    chunk = ensemble_chunk_size(paths, steps, memory_budget)
+    for start in range(0, count, chunk):
+        stop = min(count, start + chunk)
+        Xc, chunk_offsets = slice_ragged(X, offsets, start, stop)
+        Yc, _ = slice_ragged(Y, offsets, start, stop)
+        X_, Y_, valid = random_walk_batch(Xc, Yc, chunk_offsets, steps, stride, n, noise, rng=rng, paths=paths)
+        yield start, stop, X_, Y_, valid
+
+
+def random_walk(X, Y, steps, stride=1, n=1, noise=0.5, keep_origin=False, rng=None, draws=None):
+    X = X.squeeze()
+    Y = Y.squeeze()
+
+    if len(X.shape) == 0 or len(Y.shape) == 0:
+        return None, None
+
+    if X.shape[0] <= 1 or Y.shape[0] <= 1:
+        return None, None
+
+    derivatives = [Y]
+    dX = np.diff(X)
+    for i in range(n):
+        dY = np.diff(derivatives[-1])
+        if i == 0:
+            derivatives.append(dY/dX)
+        else:
+            derivatives.append(dY)
+    last = derivatives.pop()
+    if rng is not None:
+        u, z = draw_walk(rng, 1, steps, noise)
+        draws = u[0], z[0]
+    if draws is None:
+        Y_ = np.random.choice(last, size=steps)
+        Y_ *= np.random.normal(loc=1.0, scale=noise, size=steps)
+    else:
+        Y_ = last[_sample_index(draws[0], last.shape[0])]
+        Y_ *= draws[1]
+    for i in range(n):
+        last_Y = derivatives.pop()
+        Y_ *= stride
+        Y_[0] += last_Y[-1]
+        Y_ = np.cumsum(Y_)
+    X_ = np.arange(steps) * stride + X[-1]
+    if keep_origin:
+        X = np.hstack((X, X_))
+        Y = np.hstack((Y, Y_))
+        return X, Y
+    else:
+        return X_, Y_
+
+
+def check_random_walk_batch(Xs, Ys, steps, stride=1, n=1, noise=0.5, seed=0):
+    # Replays every uploader through the per-uid random_walk with the same
+    # draws, the batch must give identical forecasts.
+    X, offsets = pack_ragged(Xs)
+    Y, _ = pack_ragged(Ys)
+    u, z = draw_walk(np.random.default_rng(seed), len(Xs), steps, noise)
+    X_, Y_, valid = random_walk_batch(X, Y, offsets, steps, stride, n, noise, draws=(u, z))
+
+    mismatches = []
+    for i in range(len(Xs)):
+        if Xs[i].shape[0] <= n:
+            if valid[i]:
+                mismatches.append(i)
+            continue
+        expected = random_walk(Xs[i], Ys[i], steps, stride, n, noise, draws=(u[i], z[i]))
+        if not (np.array_equal(X_[i], expected[0]) and np.array_equal(Y_[i], expected[1], equal_nan=True)):
+            mismatches.append(i)
+    return mismatches
@@ -0,0 +1,72 @@
+import json
+import numpy as np
+import pandas as pd
+from timestamps import to_timestamps
+
+# Older crawls wrote the video records with different key names
+KEY_ALIASES = {
+    'Aid': 'AVNum', 'Name': 'Topic', 'Time': 'UploadTime'
+    , 'Danmaku': 'DMNum', 'DMnum': 'DMNum', 'reply': 'Comment'
+    , 'favorite': 'Save', 'coin': 'Coin', 'like': 'Like'
+}
+
+COUNT_COLUMNS = ('DMNum', 'Comment', 'Save', 'Coin', 'Like')
+
+# Separators between records: the files are either one JSON array, several
+# arrays merged back to back, or one object per line with trailing commas.
+_SEPARATORS = ' \n\r\t[],'
+
+_decoder = json.JSONDecoder()
+
+
+def iter_video_records(buf):
+    pos, end = 0, len(buf)
+    while True:
+        while pos < end and buf[pos] in _SEPARATORS:
+            pos += 1
+        if pos >= end:
+            return
+        record, pos = _decoder.raw_decode(buf, pos)
+        yield {KEY_ALIASES.get(key, key): value for key, value in record.items()}
+
+
+def _float(value):
+    return np.nan if value is None else float(value)
+
+
+def build_video_frame(records, upload_times):
+    columns = {}
+    for record in records:
+        for key in record:
+            if key not in columns:
+                columns[key] = None
+    keys = list(columns)
+
+    for key in keys:
+        values = [record.get(key) for record in records]
+        if key == 'AVNum':
+            columns[key] = np.array([int(v) for v in values], dtype=np.int64)
+        elif key == 'UploadTime':
+            columns[key] = upload_times
+        elif key in COUNT_COLUMNS:
+            columns[key] = np.array([_float(v) for v in values], dtype=np.float64)
+        else:
+            columns[key] = pd.Series(values, dtype=None if values else object)
+    return pd.DataFrame(columns, index=pd.RangeIndex(len(records)))
+
+
+def scan_historical_json(path, tail=None, since=None):
+    with open(path, 'r', encoding="utf-8") as f:
+        records = list(iter_video_records(f.read()))
+
+    times = to_timestamps(pd.Series([r.get('UploadTime') for r in records], dtype=object))
+    recent = None
+    if since is not None:
+        recent = int(np.count_nonzero(times >= since))
+
+    # Rows come back in UploadTime order, only the newest `tail` are typed
+    order = np.argsort(times, kind='stable')
+    if tail is not None:
+        order = order[max(0, order.shape[0]-tail):]
+    df = build_video_frame([records[i] for i in order], times[order])
+    return df, recent
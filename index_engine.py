@@ -0,0 +1,280 @@
+import sys
+import math
+import numpy as np
+import pandas as pd
+
+# Per-uploader inputs gathered by dataminer before the derived indices are
+# computed in one vectorized pass over the whole table.
+INDEX_INPUTS = (
+    'ViewsNow', 'ViewsWeekAgo', 'AvgView', 'AvgScore', 'AvgQuality'
+    , 'RecentCount', 'FansWeekAgo', 'FansNow', 'FanNum'
+    , 'ChargesMonthly', 'ViewsMonthly'
+)
+
+INDEX_OUTPUTS = (
+    'WorkIndex', 'FanIncPercentage', 'FanIncIndex', 'SummaryIndex'
+    , 'IncomeYearly', 'IncomePerVideo', 'ChannelValue'
+)
+
+
+def gather_columns(df, names=INDEX_INPUTS):
+    cols = {}
+    for name in names:
+        if name in df.columns:
+            cols[name] = pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=np.float64)
+        else:
+            cols[name] = np.full(df.shape[0], np.nan)
+    return cols
+
+
+# The scalar path turns every exception (ZeroDivisionError, OverflowError,
+# ValueError from math.log) and every complex result into NaN. The helpers
+# below reproduce exactly that on whole columns.
+
+def _div(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = np.true_divide(a, b)
+    return np.where(b == 0, np.nan, out)
+
+
+# float_power and math.log round exactly like the scalar path, the SIMD
+# np.power/np.log loops can be off by an ulp.
+def _pow(a, p):
+    with np.errstate(invalid='ignore', over='ignore'):
+        out = np.float_power(a, p)
+    # Negative bases already yield NaN; overflow raised in the scalar path
+    return np.where(np.isinf(out) & np.isfinite(a), np.nan, out)
+
+
+def _log(a):
+    a = np.where(a > 0, a, np.nan)
+    out = np.fromiter(map(math.log, a.ravel().tolist()), dtype=np.float64, count=a.size)
+    return out.reshape(a.shape)
+
+
+def fast_log(a):
+    # np.log, for callers that do not need to match the scalar path
+    return np.log(np.where(a > 0, a, np.nan))
+
+
+'''
+（(87 % * 5/1000 + 13 % * 15/1000 * K) * B * S * 30/2）* 3.49 + K * N*ln（N）/ 2
+s = 30-7天发布视频数
+B = 平均视频播放量
+K = （两次根号下月充电/播放比）* 100
+N = 粉丝数*根号下【（粉丝量/平均视频播放量）* 2 *（平均赞赏/平均播放比）】
+
+(87 % * 5/1000 + 13 % * 15/1000 * K) * B * S * 30
+这个是频道每年收入
+
+平均视频收入是
+(87 % * 5/1000 + 13 % * 15/1000 * K) * B
+'''
+
+
+# Every derived index is a metric: a vectorized function of input columns
+# and of other metrics. evaluate() runs only the requested metrics and what
+# they depend on, in dependency order. A new index is one more @metric.
+
+class Metric:
+    def __init__(self, name, function, inputs=(), depends=()):
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.depends = tuple(depends)
+
+
+METRICS = {}
+
+
+def metric(name, inputs=(), depends=()):
+    def register(function):
+        METRICS[name] = Metric(name, function, inputs, depends)
+        return function
+    return register
+
+
+@metric('WorkIndex', inputs=('ViewsNow', 'ViewsWeekAgo', 'AvgView', 'AvgQuality', 'RecentCount'))
+def _work_index(v):
+    L4, L3 = v['ViewsNow'], v['ViewsWeekAgo']
+    O4, N4, P4 = v['AvgView'], v['AvgQuality'], v['RecentCount']
+    return _pow(_div((_pow(N4, 1.1) + (L4-L3)/10) * (N4-O4), O4) * P4 / 30, 0.65) / 10
+
+
+@metric('FanIncPercentage', inputs=('FansWeekAgo', 'FansNow'))
+def _fan_inc_percentage(v):
+    K3, K4 = v['FansWeekAgo'], v['FansNow']
+    return _div(K4 - K3, K3)
+
+
+@metric('FanIncIndex', inputs=('FansWeekAgo', 'FansNow'), depends=('FanIncPercentage',))
+def _fan_inc_index(v):
+    K3, K4 = v['FansWeekAgo'], v['FansNow']
+    return _pow((K4 - K3) * v['FanIncPercentage'], 0.75) * np.where(K4 > K3, 1, -1)
+
+
+@metric('SummaryIndex', inputs=('ViewsNow', 'ViewsWeekAgo', 'FansNow'), depends=('WorkIndex', 'FanIncIndex'))
+def _summary_index(v):
+    L4, L3, K4 = v['ViewsNow'], v['ViewsWeekAgo'], v['FansNow']
+    S3, R4 = v['WorkIndex'], v['FanIncIndex']
+    return (S3+R4) * _pow(K4/1000 + (L4-L3)/10000, 0.7) / 1000
+
+
+@metric('ChargeRatio', inputs=('ChargesMonthly', 'ViewsMonthly'))
+def _charge_ratio_metric(v):
+    return _charge_ratio(v['ChargesMonthly'], v['ViewsMonthly'])
+
+
+@metric('IncomeYearly', inputs=('AvgView', 'RecentCount'), depends=('ChargeRatio',))
+def _income_yearly(v):
+    S = v['RecentCount']
+    B = v['AvgView']
+    K = v['ChargeRatio']
+    return ((0.87 * 5/1000 + 0.13 * 15/1000 * K) * B * S * 30)
+
+
+@metric('IncomePerVideo', inputs=('RecentCount',), depends=('IncomeYearly',))
+def _income_per_video(v):
+    S = v['RecentCount']
+    return np.where(S == 0, 0.0, _div(v['IncomeYearly'], S*30))
+
+
+@metric('ChannelValue', inputs=('FanNum', 'AvgView', 'AvgScore'), depends=('IncomeYearly', 'ChargeRatio'))
+def _channel_value(v):
+    return channel_value(v['FanNum'], v['AvgView'], v['AvgScore'], v['IncomeYearly'], v['ChargeRatio'])
+
+
+def metric_order(names, known=()):
+    order, visiting, done = [], set(), set(known)
+
+    def visit(name):
+        if name in done:
+            return
+        if name not in METRICS:
+            raise KeyError("Unknown metric %s" % name)
+        if name in visiting:
+            raise ValueError("Metric dependency cycle at %s" % name)
+        visiting.add(name)
+        for dependency in METRICS[name].depends:
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in names:
+        visit(name)
+    return order
+
+
+def evaluate(names, source):
+    # source is either a DataFrame, whose input columns are gathered only
+    # when a metric needs them, or a dict of arrays. Values in the dict are
+    # used as given, even for a metric (the predictor passes IncomeYearly).
+    if isinstance(source, pd.DataFrame):
+        values = {}
+    else:
+        values = dict(source)
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        for name in metric_order(names, known=values):
+            m = METRICS[name]
+            for field in m.inputs:
+                if field not in values:
+                    if not isinstance(source, pd.DataFrame):
+                        raise KeyError("Missing input %s for metric %s" % (field, name))
+                    values.update(gather_columns(source, (field,)))
+            values[name] = m.function(values)
+    return {name: values[name] for name in names}
+
+
+def compute_indices(cols, names=INDEX_OUTPUTS):
+    return evaluate(names, cols)
+
+
+def _charge_ratio(charges_monthly, views_monthly):
+    return _pow(_div(charges_monthly, views_monthly), 0.5) * 100
+
+
+def channel_value(fan_num, avg_view, avg_score, income_yearly, K=None,
+                  charges_monthly=None, views_monthly=None, log=_log):
+    with np.errstate(invalid='ignore', over='ignore'):
+        if K is None:
+            K = _charge_ratio(charges_monthly, views_monthly)
+        N = fan_num * _pow(_div(fan_num, avg_view) * 2 * _div(avg_score, avg_view), 0.5)
+        X = income_yearly
+        return (X/2) * 3.49 + K * N * log(N) / 2
+
+
+def apply_indices(df, failed=None, names=INDEX_OUTPUTS):
+    out = evaluate(names, df)
+    for name in names:
+        values = out[name]
+        if failed is not None:
+            values = np.where(failed, np.nan, values)
+        df[name] = values
+    return df
+
+###############################################################################
+# Scalar reference path, kept to check the engine against.
+
+
+def _scalar(f):
+    try:
+        v = f()
+    except Exception:
+        return float('Nan')
+    if isinstance(v, complex):
+        return float('Nan')
+    return v
+
+
+def compute_indices_row(info):
+    info = {k: float(info[k]) for k in INDEX_INPUTS}
+    L4, L3, O4, N4, P4 = info['ViewsNow'], info['ViewsWeekAgo'], info['AvgView'], info['AvgQuality'], info['RecentCount']
+    K3, K4 = info['FansWeekAgo'], info['FansNow']
+
+    out = {}
+    out['WorkIndex'] = _scalar(lambda: ((N4**1.1 + (L4-L3)/10) * (N4-O4) / O4 * P4 / 30) ** 0.65 / 10)
+    out['FanIncPercentage'] = _scalar(lambda: (K4 - K3) / K3)
+    out['FanIncIndex'] = _scalar(lambda: ((K4 - K3) * out['FanIncPercentage']) ** 0.75 * (1 if K4 > K3 else -1))
+
+    S3, R4 = out['WorkIndex'], out['FanIncIndex']
+    out['SummaryIndex'] = _scalar(lambda: (S3+R4)*(K4/1000+(L4-L3)/10000) ** 0.7 / 1000)
+
+    S = info['RecentCount']
+    B = info['AvgView']
+    K = _scalar(lambda: (info['ChargesMonthly']/info['ViewsMonthly']) ** 0.5 * 100)
+    N = _scalar(lambda: info['FanNum'] * (info['FanNum']/info['AvgView'] * 2 * (info['AvgScore']/info['AvgView'])) ** 0.5)
+    out['IncomeYearly'] = _scalar(lambda: ((0.87 * 5/1000 + 0.13 * 15/1000 * K) * B * S * 30))
+
+    try:
+        out['IncomePerVideo'] = out['IncomeYearly'] / (info['RecentCount']*30)
+    except:
+        out['IncomePerVideo'] = 0.0
+
+    X = out['IncomeYearly']
+    out['ChannelValue'] = _scalar(lambda: (X/2) * 3.49 + K * N * math.log(N) / 2)
+    return out
+
+
+def check_indices(df):
+    out = compute_indices(gather_columns(df))
+    mismatches = []
+    for i, (_, row) in enumerate(df.iterrows()):
+        expected = compute_indices_row(row)
+        for name in INDEX_OUTPUTS:
+            a, b = out[name][i], expected[name]
+            if not (a == b or (math.isnan(a) and math.isnan(b))):
+                mismatches.append((row.get('uid'), name, a, b))
+    return mismatches
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        exit()
+
+    df = pd.read_json(sys.argv[1], orient='records', encoding='utf-8')
+    mismatches = check_indices(df)
+    for uid, name, a, b in mismatches:
+        print("Mismatch uid %s %s: %r != %r" % (uid, name, a, b))
+    print("Checked %d rows, %d mismatches." % (df.shape[0], len(mismatches)))
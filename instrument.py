@@ -0,0 +1,126 @@
+import sys, os
+import time
+import atexit
+import cProfile
+import pstats
+import multiprocessing.util
+from collections import defaultdict
+from contextlib import contextmanager
+import numpy as np
+
+# Buffered logging, counters and timers for the pipeline scripts. A run
+# ends by writing its metrics to a local file in the Prometheus text format
+# (<script>.prom next to the logs).
+
+
+class Logger:
+    # Drop-in for write_log(s, verbose=True). Lines are kept in memory and
+    # appended to the log file in batches instead of reopening it per line.
+    # A forked worker starts with an empty buffer and flushes its own lines
+    # when it exits.
+    def __init__(self, path, buffer_lines=256):
+        self.path = path
+        self.buffer_lines = buffer_lines
+        self.lines = []
+        self.pid = os.getpid()
+        atexit.register(self.flush)
+
+    def __call__(self, s, verbose=True):
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.lines = []
+            multiprocessing.util.Finalize(None, self.flush, exitpriority=0)
+        if verbose:
+            print(s)
+        self.lines.append(str(s))
+        if len(self.lines) >= self.buffer_lines:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            return
+        lines, self.lines = self.lines, []
+        with open(self.path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in sorted(labels))
+
+
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.counters = defaultdict(float)
+        self.samples = defaultdict(list)
+
+    def count(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, seconds, **labels):
+        self.samples[(name, tuple(sorted(labels.items())))].append(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def merge(self, counters=None, samples=None):
+        # Folds in plain dicts like those a pool worker returns per uid
+        for name, value in (counters or {}).items():
+            self.count(name, value)
+        for name, seconds in (samples or {}).items():
+            self.observe(name, seconds)
+
+    def summary(self, name, **labels):
+        values = np.array(self.samples.get((name, tuple(sorted(labels.items()))), ()))
+        if values.shape[0] == 0:
+            return None
+        p50, p95 = np.percentile(values, [50, 95])
+        return {'count': values.shape[0], 'sum': values.sum(), 'p50': p50, 'p95': p95}
+
+    def to_prometheus(self):
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            metric = '%s_%s_total' % (self.prefix, name)
+            if metric not in typed:
+                lines.append('# TYPE %s counter' % metric)
+                typed.add(metric)
+            lines.append('%s%s %r' % (metric, _labels(labels), float(value)))
+        for (name, labels), values in sorted(self.samples.items()):
+            metric = '%s_%s_seconds' % (self.prefix, name)
+            if metric not in typed:
+                lines.append('# TYPE %s summary' % metric)
+                typed.add(metric)
+            values = np.array(values)
+            for q in (0.5, 0.95):
+                quantile = labels + (('quantile', q),)
+                lines.append('%s%s %r' % (metric, _labels(quantile), float(np.percentile(values, q * 100))))
+            lines.append('%s_sum%s %r' % (metric, _labels(labels), float(values.sum())))
+            lines.append('%s_count%s %d' % (metric, _labels(labels), values.shape[0]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+def profile_run(function, path, top=25):
+    # Opt-in: one run under cProfile, the stats are dumped to path and the
+    # hottest functions printed
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        function()
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(top)
@@ -0,0 +1,50 @@
+import sys
+import importlib
+
+# Single entry point for the pipeline scripts:
+#
+# python pipeline.py <command> [options]
+#
+# Only the module of the command is imported, after the command was picked,
+# so pandas/numpy/requests are loaded by the commands that use them and
+# `pipeline.py --help` starts without any of them. Every command takes the
+# same options as running its script directly.
+
+# command: (module, description)
+COMMANDS = {
+    'archive': ('archive_up_records', 'archive the snapshots of this month into ../A'),
+    'mine': ('dataminer', 'mine the uploaders of ../Apic/a.json into a.json'),
+    'predict': ('predictor', 'forecast the uploaders of a.json into ../P'),
+    'export-face': ('export_face', 'export the avatar of every uploader to face.json'),
+    'avatars': ('avatars', 'refresh the avatar cache'),
+    'schedule': ('scheduler', 'run archive, mine and predict every night'),
+    'rank': ('rank_index', 'query the rank indexes of a.json'),
+    'trends': ('trend_store', 'query or import the metric history'),
+}
+
+
+def usage(prog):
+    lines = ["usage: %s <command> [options]" % prog, "", "commands:"]
+    for name, (_, description) in COMMANDS.items():
+        lines.append("  %-12s %s" % (name, description))
+    lines.append("")
+    lines.append("%s <command> --help shows the options of a command" % prog)
+    return '\n'.join(lines)
+
+
+def main(argv=None, prog='pipeline.py'):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage(prog))
+        return 0
+    if argv[0] not in COMMANDS:
+        print("%s: unknown command %s\n" % (prog, argv[0]), file=sys.stderr)
+        print(usage(prog), file=sys.stderr)
+        return 2
+
+    module = importlib.import_module(COMMANDS[argv[0]][0])
+    return module.main(argv[1:], prog='%s %s' % (prog, argv[0]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
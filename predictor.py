@@ -1,172 +1,256 @@
-import sys, os, shutil
+import os
 import datetime
 import time
-import math
-import sklearn
 import pandas as pd
 import numpy as np
 from threading import Timer
+import argparse
+import warnings
+from series_store import open_series
+from forecast import pack_ragged, random_walk_batch, iter_ensemble
+from index_engine import evaluate, channel_value, fast_log
+from records_io import read_columns, write_records
+from instrument import Logger, Metrics, profile_run
+from run_lock import run_locked
+
+g_log = Logger('predictor.log')
+g_metrics = Metrics('predictor')
 
 def write_log(s, verbose=True):
-    if verbose:
-        print(s)
-    with open('predictor.log', 'a') as f:
-        print(s, file=f)
+    g_log(s, verbose)
 
 
-def parse_datetime(row, column, fmt='%Y-%m-%d %H:%M:%S'):
-    dt = row[column]
-    if isinstance(row[column], str):
-        dt = time.mktime(time.strptime(row[column].strip(), fmt))
-    return dt
+g_seed = None
+g_steps = 24//3 * 7*2
+g_stride = 3
+g_paths = 1
+g_percentiles = (10, 90)
+g_ensemble_memory = 256 << 20
 
+# The only a.json fields the forecast reads
+INFO_COLUMNS = ('uid', 'AvgView', 'AvgScore', 'IncomeYearly', 'ChargesMonthly', 'ViewsMonthly')
 
-def parse_int(row, column):
-    return int(row[column])
+def load_uploader(series, uid, timestamp):
+    df = series.read_frame(uid)
+    fields = ['PlayNum', 'FanNum', 'ChargeNum']
+    df[fields] = df[fields].astype(np.float64)
+    df.sort_values(by='Time', inplace=True, ascending=True, kind='stable')
 
+    df = df.loc[df['Time']>timestamp].copy()
+    df['Time'] = (df['Time'] - timestamp) / (60*60)
+    return df
 
-def parse_float(row, column):
-    return float(row[column])
-
-
-def time_transform(row, column, translate, scale):
-    return (row[column] - translate) / scale
-
-
-def time_inv_transform(row, column, translate, scale):
-    return row[column] * scale + translate
-
-
-def cast_dataframe(df, casts):
-    for col, parser in casts:
-        df[col] = df.apply(parser, axis=1, args=(col,))
-
-def random_walk(X, Y, steps, stride=1, n=1, noise=0.5, keep_origin=False):
-    X = X.squeeze()
-    Y = Y.squeeze()
-
-    if len(X.shape) == 0 or len(Y.shape) == 0:
-        return None, None
-
-    if X.shape[0] <= 1 or Y.shape[0] <= 1:
-        return None, None
-
-    derivatives = [Y]
-    dX = np.diff(X)
-    for i in range(n):
-        dY = np.diff(derivatives[-1])
-        if i == 0:
-            derivatives.append(dY/dX)
-        else:
-            derivatives.append(dY)
-    Y_ = np.random.choice(derivatives.pop(), size=steps)
-    Y_ *= np.random.normal(loc=1.0, scale=noise, size=steps)
-    for i in range(n):
-        last_Y = derivatives.pop()
-        Y_ *= stride
-        Y_[0] += last_Y[-1]
-        Y_ = np.cumsum(Y_)
-    X_ = np.arange(steps) * stride + X[-1]
-    if keep_origin:
-        X = np.hstack((X, X_))
-        Y = np.hstack((Y, Y_))
-        return X, Y
+def field_series(df, field):
+    if field == 'PlayNum':
+        diff = df['PlayNum'].diff()
+        subdf = df.loc[diff.abs() > 1e-8]
+    else:
+        subdf = df
+    subdf = subdf.dropna(subset=[field])
+    return subdf['Time'].to_numpy(), subdf[field].to_numpy()
+
+def index_uploaders(up_list):
+    # One row per uid, the first one like up_list.loc[up_list['uid']==uid].iloc[0]
+    up_info = up_list.drop_duplicates(subset='uid', keep='first')
+    return pd.Index(up_info['uid']), up_info
+
+def info_column(info, name):
+    if name not in info.columns:
+        return np.full(info.shape[0], np.nan)
+    return pd.to_numeric(info[name], errors='coerce').to_numpy(dtype=np.float64)
+
+def forecast_channel_value(fan_num, info, exact=True):
+    # fan_num is (uploaders, ..., steps), the per-uploader inputs broadcast.
+    # Without exact the log is np.log rather than the scalar path's math.log.
+    shape = (slice(None),) + (np.newaxis,) * (fan_num.ndim - 1)
+    values = {name: info_column(info, name)[shape] for name in
+              ('AvgView', 'AvgScore', 'IncomeYearly', 'ChargesMonthly', 'ViewsMonthly')}
+    values['FanNum'] = fan_num.astype(np.float64)
+    if not exact:
+        return channel_value(values['FanNum'], values['AvgView'], values['AvgScore'], values['IncomeYearly'],
+                             charges_monthly=values['ChargesMonthly'], views_monthly=values['ViewsMonthly'],
+                             log=fast_log)
+    return evaluate(['ChannelValue'], values)['ChannelValue']
+
+def band_name(name, q):
+    # The median keeps the field name, 2.5 becomes <name>_p2_5
+    return name if q == 50 else '%s_p%s' % (name, ('%g' % q).replace('.', '_'))
+
+def path_percentiles(values, quantiles):
+    # np.nanpercentile over axis 1 (the paths) without its per-slice Python
+    # loop, and faster than np.percentile's partition for several quantiles:
+    # one sort, NaN last, then every (uploader, step) slice interpolates
+    # between the sorted entries below its own count of valid paths
+    ordered = np.sort(values, axis=1)
+    # A slice whose last entry is a number has no NaN at all
+    nan_last = np.isnan(ordered[:, -1:])
+    if nan_last.any():
+        count = np.count_nonzero(~np.isnan(ordered), axis=1)[:, np.newaxis]
     else:
-        return X_, Y_
-    
+        count = np.full(nan_last.shape, values.shape[1])
+    last = np.maximum(count - 1, 0)
+    bands = []
+    for q in quantiles:
+        position = last * (q / 100.0)
+        below = np.floor(position).astype(np.intp)
+        above = np.minimum(below + 1, last)
+        t = (position - below)[:, 0]
+        a = np.take_along_axis(ordered, below, axis=1)[:, 0]
+        b = np.take_along_axis(ordered, above, axis=1)[:, 0]
+        # numpy's lerp, exact at both ends
+        band = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+        bands.append(np.where(count[:, 0] > 0, band, np.nan))
+    return np.array(bands)
+
+def forecast_path(packed, info, rng, timestamp):
+    # All uploaders are forecast together, one 2D array per field
+    prediction = {}
+    valid = np.ones(info.shape[0], dtype=bool)
+    for field, (X, Y, offsets) in packed.items():
+        X_, Y_, field_valid = random_walk_batch(X, Y, offsets, g_steps, n=1, stride=g_stride, rng=rng)
+        if 'Time' not in prediction:
+            prediction['Time'] = X_ * (60*60) + timestamp
+        prediction[field] = Y_
+        valid &= field_valid
+
+    finite = np.isfinite(prediction['FanNum']).all(axis=1) & np.isfinite(prediction['PlayNum']).all(axis=1)
+    for field in packed:
+        prediction[field] = np.trunc(np.where(finite[:, np.newaxis], prediction[field], 0)).astype(np.int64)
+
+    prediction['ChannelValue'] = forecast_channel_value(prediction['FanNum'], info)
+    return prediction, valid, finite
+
+def forecast_ensemble(packed, info, rng, timestamp):
+    # g_paths paths per uploader, the median is written under the field name
+    # and every other percentile under band_name. Yields one chunk of
+    # uploaders at a time, (start, stop, prediction, valid, finite), so only
+    # a chunk of predictions is held before it is written.
+    quantiles = sorted(set(g_percentiles) | {50})
+    chunks = [iter_ensemble(X, Y, offsets, g_steps, g_paths, n=1, stride=g_stride, rng=rng,
+                            memory_budget=g_ensemble_memory)
+              for X, Y, offsets in packed.values()]
+    for field_chunks in zip(*chunks):
+        start, stop = field_chunks[0][:2]
+        bands = {}
+        valid = np.ones(stop - start, dtype=bool)
+        finite = np.ones(stop - start, dtype=bool)
+        paths = {}
+        for field, (_, _, X_, Y_, field_valid) in zip(packed, field_chunks):
+            if field == 'FanNum':
+                times = X_ * (60*60) + timestamp
+            valid &= field_valid
+            field_finite = np.isfinite(Y_).all(axis=(1, 2))
+            finite &= field_finite
+            paths[field] = np.trunc(np.where(field_finite[:, np.newaxis, np.newaxis], Y_, 0))
+            for q, band in zip(quantiles, path_percentiles(paths[field], quantiles)):
+                bands[field, q] = np.trunc(np.nan_to_num(band)).astype(np.int64)
+
+        channel_value = forecast_channel_value(paths['FanNum'], info.iloc[start:stop], exact=False)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            for q, band in zip(quantiles, path_percentiles(channel_value, quantiles)):
+                bands['ChannelValue', q] = band
+
+        # Time, the medians, then every other band field by field
+        prediction = {'Time': times}
+        for q in [50] + [q for q in quantiles if q != 50]:
+            for name in list(packed) + ['ChannelValue']:
+                prediction[band_name(name, q)] = bands[name, q]
+        yield start, stop, prediction, valid, finite
+
 def predict_worker():
     # if os.path.exists('p.json'):
     #     now = datetime.datetime.now().timetuple()
     #     dstname = time.strftime("%Y-%m-%d-%H-%M-%S.json")
     #     shutil.copyfile('p.json', dstname)
 
+    global g_metrics
+    g_metrics = Metrics('predictor')
+
     if not os.path.exists('../P'):
         os.mkdir('../P')
 
-    up_list = pd.read_json('a.json')
-
-    for filename in os.listdir('../A'):
-        basename, extname = os.path.splitext(filename)
-        if basename.startswith('.'): continue
-        if extname.lower() != '.csv': continue
-
+    with g_metrics.timer('stage', step='read_list'):
+        up_list = read_columns(g_records_path, INFO_COLUMNS)
+    series = open_series(g_series_path)
+    rng = np.random.default_rng(g_seed)
+
+    today = datetime.date.today()
+    month_ago = today - datetime.timedelta(days=30)
+    timestamp = time.mktime(month_ago.timetuple())
+
+    index, up_info = index_uploaders(up_list)
+    series_uids = series.uids()
+    positions = index.get_indexer(series_uids)
+    missing = [uid for uid, position in zip(series_uids, positions.tolist()) if position < 0]
+    if missing:
+        write_log("No such up (%d): %s" % (len(missing), ', '.join(map(str, missing))), verbose=True)
+
+    uids, rows, frames = [], [], []
+    for uid, position in zip(series_uids, positions.tolist()):
+        if position < 0:
+            continue
         try:
+            with g_metrics.timer('uid_read'):
+                frames.append(load_uploader(series, uid, timestamp))
+            rows.append(position)
+            uids.append(uid)
+        except Exception as e:
+            write_log("Failed to predict %s" % uid, verbose=True)
+            g_metrics.count('failures', error=type(e).__name__)
+
+    forecast_start = time.perf_counter()
+    fields = ['FanNum', 'PlayNum']
+    packed = {}
+    for field in fields:
+        Xs, Ys = zip(*[field_series(df, field) for df in frames]) if frames else ((), ())
+        X, offsets = pack_ragged(Xs)
+        Y, _ = pack_ragged(Ys)
+        packed[field] = (X, Y, offsets)
+    info = up_info.iloc[rows]
+
+    if g_paths > 1:
+        chunks = forecast_ensemble(packed, info, rng, timestamp)
+    else:
+        chunks = [(0, len(uids)) + forecast_path(packed, info, rng, timestamp)]
+
+    # Every chunk is written before the next one is forecast
+    forecast_seconds = 0.0
+    for start, stop, prediction, valid, finite in chunks:
+        forecast_seconds += time.perf_counter() - forecast_start
+        write_predictions(uids[start:stop], prediction, valid, finite)
+        forecast_start = time.perf_counter()
+    forecast_seconds += time.perf_counter() - forecast_start
+    g_metrics.observe('stage', forecast_seconds, step='forecast')
+
+    g_metrics.count('uploaders', len(series_uids))
+    g_metrics.write('predictor.prom')
+    g_log.flush()
+
+def write_predictions(uids, prediction, valid, finite):
+    for i, uid in enumerate(uids):
+        if not valid[i]:
+            write_log("Data is too less: %s" % uid, verbose=True)
+            write_log("Failed to predict %s" % uid, verbose=True)
+            g_metrics.count('failures', error='TooLittleData')
+            continue
+        if not finite[i]:
+            write_log("Failed to predict %s" % uid, verbose=True)
+            g_metrics.count('failures', error='NotFinite')
+            continue
 
-            uid = int(basename)
-            up_info = up_list.loc[up_list['uid'] == uid]
-            if up_info.shape[0] == 0:
-                write_log("No such up: %s" % uid, verbose=True)
-                raise "No such up."
-            up_info = up_info.iloc[0]
-
-            df = pd.read_csv(os.path.join('../A', filename))
-
-            casts = (
-                ('Time', parse_datetime), ('PlayNum', parse_float)
-                , ('FanNum', parse_float), ('ChargeNum', parse_float)
-            )
-            cast_dataframe(df, casts)
-            df.sort_values(by='Time', inplace=True, ascending=True)
-
-            today = datetime.date.today()
-            month_ago = today - datetime.timedelta(days=30)
-            timestamp = time.mktime(month_ago.timetuple())
-
-            df = df.loc[df['Time']>timestamp]
-            df['Time'] = df.apply(time_transform, axis=1, args=('Time', timestamp, 60*60))
-
-            fields = ['FanNum', 'PlayNum']
-            prediction = None
-            for field in fields:
-                if field == 'PlayNum':
-                    diff = df['PlayNum'].diff()
-                    subdf = df.loc[diff.abs() > 1e-8]
-                else:
-                    subdf = df
-                subdf = subdf.dropna(subset=[field])
-
-                X = subdf['Time'].to_numpy()
-                Y = subdf[field].to_numpy()
-
-                steps = 24//3 * 7*2
-                X_, Y_ = random_walk(X, Y, steps, n=1, stride=3)
-
-                if X_ is None or Y_ is None:
-                    write_log("Data is too less: %s" % filename, verbose=True)
-                    raise "Data is too less"
-
-                X_ = X_[:, np.newaxis]
-                Y_ = Y_[:, np.newaxis]
-
-                if prediction is None:
-                    prediction = X_
-
-                prediction = np.hstack((prediction, Y_))
-
-            pred_df = pd.DataFrame(data=prediction, columns=['Time', 'FanNum', 'PlayNum'])
-            casts = (('FanNum', parse_int), ('PlayNum', parse_int))
-            cast_dataframe(pred_df, casts)
-            pred_df['Time'] = pred_df.apply(time_inv_transform, axis=1, args=('Time', timestamp, 60*60))
-
-            def predict_channel_value(row, info):
-                try:
-                    K = (info['ChargesMonthly']/info['ViewsMonthly']) ** 0.5 * 100
-                    N = row['FanNum'] * (row['FanNum']/info['AvgView'] * 2 * (info['AvgScore']/info['AvgView'])) ** 0.5
-                    X = info['IncomeYearly']
-                    channelValue = (X/2) * 3.49 + K * N * math.log(N) / 2
-                except:
-                    channelValue = float('Nan')
-                return channelValue
-            pred_df['ChannelValue'] = pred_df.apply(predict_channel_value, axis=1, args=(up_info,))
-
-            s = pred_df.to_json(orient='records')
-            path = os.path.join('../P', basename+'.json')
-            with open(path, 'w', encoding='utf-8') as f:
-                f.write(s)
+        try:
+            pred_df = pd.DataFrame({name: values[i] for name, values in prediction.items()})
+            path = os.path.join('../P', str(uid)+'.json')
+            with g_metrics.timer('uid_write'):
+                write_records(path, pred_df, fsync=False)
+            g_metrics.count('bytes_written', os.path.getsize(path))
+            g_metrics.count('predicted')
             now = datetime.datetime.now().timetuple()
-            write_log("Finished predicting %s at %s" % (filename, time.strftime("%Y-%m-%d %H:%M:%S", now)), verbose=True)
+            write_log("Finished predicting %s at %s" % (uid, time.strftime("%Y-%m-%d %H:%M:%S", now)), verbose=True)
         except Exception as e:
-            write_log("Failed to predict %s" % filename, verbose=True)
+            write_log("Failed to predict %s" % uid, verbose=True)
+            g_metrics.count('failures', error=type(e).__name__)
 
 """
 g_current_times = 0
@@ -186,10 +270,12 @@ def on_timeout():
 """
 
 g_invoke_first = False
+g_series_path = '../A'
+g_records_path = 'a.json'
 def on_timeout():
     global g_invoke_first
     if g_invoke_first:
-        predict_worker()
+        run_locked(predict_worker, write_log)
     g_invoke_first = True
 
     now = datetime.datetime.now()
@@ -201,14 +287,38 @@ def on_timeout():
         next_time = now.replace(hour=start_hour, minute=0, second=0)
     interval = (next_time-now).seconds
     write_log("Next execution %d seconds later" % interval)
+    g_log.flush()
 
     timer = Timer(interval, on_timeout)
     timer.start()
 
-if __name__ == "__main__":
-    # Run immediately first
-    if len(sys.argv) >= 2 and sys.argv[1] == '--now':
-        g_invoke_first = True
-
+def main(argv=None, prog=None):
+    global g_invoke_first, g_seed, g_records_path, g_paths, g_percentiles, g_ensemble_memory, g_series_path
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('--now', action='store_true', help='run immediately first')
+    parser.add_argument('--store', help='read the time series from this series store instead of ../A')
+    parser.add_argument('--seed', type=int, help='seed the forecast random walk')
+    parser.add_argument('--paths', type=int, default=1, help='simulate this many paths per uploader and write percentile bands')
+    parser.add_argument('--percentiles', default='10,90', help='comma separated percentile bands written with --paths')
+    parser.add_argument('--ensemble-memory', type=int, default=256, help='memory budget of the path ensemble in MB')
+    parser.add_argument('--profile', help='run once under cProfile and dump the stats to this file')
+    parser.add_argument('--records', default='a.json', help='mined uploaders, a .jsonl path is read as JSON Lines')
+    args = parser.parse_args(argv)
+
+    g_invoke_first = args.now
+    g_seed = args.seed
+    g_records_path = args.records
+    g_paths = max(1, args.paths)
+    g_percentiles = tuple(float(q) if '.' in q else int(q) for q in args.percentiles.split(',') if q)
+    g_ensemble_memory = args.ensemble_memory << 20
+    if args.store:
+        g_series_path = args.store
+
+    if args.profile:
+        profile_run(predict_worker, args.profile)
+        return
     on_timeout()
 
+
+if __name__ == "__main__":
+    main()
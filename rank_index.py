@@ -0,0 +1,226 @@
+import os, shutil
+import json
+import argparse
+import numpy as np
+from records_io import read_columns, source_stat, replace_dir
+
+# Persisted rankings of the derived indices, written by dataminer next to
+# the table as <path>.rank/:
+#
+# uids.npy              every uid of the table, ascending
+# <metric>.order.npy    ranked uids, highest value first, ties by uid
+# <metric>.values.npy   their values, same order
+# <metric>.rank.npy     0 based rank of each uid in uids.npy, -1 for NaN
+# meta.json             metrics, counts and the size/mtime of the table
+#
+# The arrays are opened memory mapped, so a top K reads K entries and the
+# rank or percentile of a uid is a couple of binary searches. When only
+# some uploaders were re-mined the previous rankings are kept and just
+# those uids are taken out and inserted again at their new place.
+
+RANK_METRICS = ('SummaryIndex', 'ChannelValue', 'FanIncIndex', 'WorkIndex')
+
+
+def rank_path(path):
+    return path + '.rank'
+
+
+def _table(path, metrics):
+    df = read_columns(path, ('uid',) + tuple(metrics))
+    # The first row of a uid counts, like the predictor's lookup
+    df = df.drop_duplicates('uid', keep='first')
+    uids = df['uid'].to_numpy(dtype=np.int64)
+    columns = {}
+    for metric in metrics:
+        if metric in df.columns:
+            columns[metric] = df[metric].to_numpy(dtype=np.float64)
+        else:
+            columns[metric] = np.full(uids.shape[0], np.nan)
+    return uids, columns
+
+
+def rank_values(uids, values):
+    ranked = ~np.isnan(values)
+    uids, values = uids[ranked], values[ranked]
+    order = np.lexsort((uids, -values))
+    return uids[order], values[order]
+
+
+def merge_ranking(order, values, drop, uids, new_values):
+    # order/values without the uids in drop, with (uids, new_values) put in
+    # where a full rank_values would have them
+    keep = ~np.isin(order, drop)
+    order, values = order[keep], values[keep]
+    uids, new_values = rank_values(uids, new_values)
+
+    n = values.shape[0]
+    ascending = values[::-1]
+    lo = n - np.searchsorted(ascending, new_values, side='right')
+    hi = n - np.searchsorted(ascending, new_values, side='left')
+    positions = lo
+    for j in np.flatnonzero(hi > lo).tolist():
+        # Equal values are ordered by uid
+        positions[j] += np.searchsorted(order[lo[j]:hi[j]], uids[j])
+    return np.insert(order, positions, uids), np.insert(values, positions, new_values)
+
+
+def load_rank_meta(path):
+    try:
+        with open(os.path.join(rank_path(path), 'meta.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build_rank_index(path, metrics=RANK_METRICS, changed=None, previous=None):
+    # changed: uids whose values may differ from the last index, previous:
+    # source_stat of the table that index was written for. Without both,
+    # or when the index on disk does not match, everything is re-ranked.
+    # Returns the number of uids that were (re)inserted.
+    metrics = tuple(metrics)
+    uids, columns = _table(path, metrics)
+    all_uids = np.sort(uids)
+
+    meta = load_rank_meta(path)
+    incremental = (changed is not None and previous is not None and meta is not None
+                   and meta['source'] == previous and tuple(meta['metrics']) == metrics)
+    if incremental:
+        old_uids = np.load(os.path.join(rank_path(path), 'uids.npy'))
+        removed = np.setdiff1d(old_uids, all_uids, assume_unique=True)
+        fresh = np.isin(uids, np.asarray(list(changed), dtype=np.int64)) | ~np.isin(uids, old_uids)
+        drop = np.concatenate([removed, uids[fresh]])
+
+    final_path = rank_path(path)
+    tmp_path = '%s.tmp-%d' % (final_path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    ranked = {}
+    for metric in metrics:
+        if incremental:
+            order, values = merge_ranking(
+                np.load(os.path.join(final_path, metric + '.order.npy')),
+                np.load(os.path.join(final_path, metric + '.values.npy')),
+                drop, uids[fresh], columns[metric][fresh])
+        else:
+            order, values = rank_values(uids, columns[metric])
+        rank = np.full(all_uids.shape[0], -1, dtype=np.int64)
+        rank[np.searchsorted(all_uids, order)] = np.arange(order.shape[0])
+        np.save(os.path.join(tmp_path, metric + '.order.npy'), order)
+        np.save(os.path.join(tmp_path, metric + '.values.npy'), values)
+        np.save(os.path.join(tmp_path, metric + '.rank.npy'), rank)
+        ranked[metric] = order.shape[0]
+    np.save(os.path.join(tmp_path, 'uids.npy'), all_uids)
+
+    meta = {'metrics': list(metrics), 'rows': all_uids.shape[0], 'ranked': ranked, 'source': source_stat(path)}
+    with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    replace_dir(tmp_path, final_path)
+    return int(fresh.sum()) if incremental else all_uids.shape[0]
+
+
+class RankIndex:
+    def __init__(self, path, meta):
+        self.path = rank_path(path)
+        self.meta = meta
+        self.uids = np.load(os.path.join(self.path, 'uids.npy'), mmap_mode='r')
+        self.arrays = {}
+
+    def _array(self, metric, kind):
+        key = (metric, kind)
+        if key not in self.arrays:
+            if metric not in self.meta['ranked']:
+                raise KeyError(metric)
+            self.arrays[key] = np.load(os.path.join(self.path, '%s.%s.npy' % (metric, kind)), mmap_mode='r')
+        return self.arrays[key]
+
+    def count(self, metric):
+        return self.meta['ranked'][metric]
+
+    def top(self, metric, k):
+        # [(uid, value)] of the k highest values
+        order, values = self._array(metric, 'order'), self._array(metric, 'values')
+        return list(zip(order[:k].tolist(), values[:k].tolist()))
+
+    def rank(self, metric, uid):
+        # 1 for the highest value, None for unknown uids and NaN values
+        i = np.searchsorted(self.uids, uid)
+        if i >= self.uids.shape[0] or self.uids[i] != uid:
+            return None
+        rank = int(self._array(metric, 'rank')[i])
+        return None if rank < 0 else rank + 1
+
+    def value(self, metric, uid):
+        rank = self.rank(metric, uid)
+        return None if rank is None else float(self._array(metric, 'values')[rank - 1])
+
+    def percentile(self, metric, uid):
+        # Share of the ranked uploaders with a lower value, in percent
+        value = self.value(metric, uid)
+        if value is None:
+            return None
+        # Binary search on the descending memmap for the end of the values
+        # >= value, which start at the top and run at least to this uid
+        values = self._array(metric, 'values')
+        lo, hi = self.rank(metric, uid), values.shape[0]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if values[mid] >= value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return 100.0 * (values.shape[0] - lo) / self.count(metric)
+
+    def value_at(self, metric, q):
+        # Value at percentile q, 100 being the highest
+        n = self.count(metric)
+        if n == 0:
+            return None
+        i = int(round((1 - q / 100.0) * (n - 1)))
+        return float(self._array(metric, 'values')[min(max(i, 0), n - 1)])
+
+
+def open_rank_index(path):
+    # None when there is no index or it was written for another table
+    meta = load_rank_meta(path)
+    try:
+        if meta is None or meta['source'] != source_stat(path):
+            return None
+    except OSError:
+        return None
+    return RankIndex(path, meta)
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('metric', choices=RANK_METRICS)
+    parser.add_argument('--records', default='a.json', help='table the index belongs to')
+    parser.add_argument('--top', type=int, help='list the uploaders with the K highest values')
+    parser.add_argument('--uid', type=int, action='append', help='rank and percentile of this uploader')
+    parser.add_argument('--value-at', type=float, help='value at this percentile')
+    parser.add_argument('--build', action='store_true', help='rebuild the index from the table first')
+    args = parser.parse_args(argv)
+
+    if args.build:
+        build_rank_index(args.records)
+    index = open_rank_index(args.records)
+    if index is None:
+        print("No up to date rank index for %s, run with --build" % args.records)
+        exit(1)
+
+    if args.top:
+        for i, (uid, value) in enumerate(index.top(args.metric, args.top)):
+            print("%6d %12d %g" % (i + 1, uid, value))
+    for uid in args.uid or ():
+        rank = index.rank(args.metric, uid)
+        if rank is None:
+            print("%d: not ranked" % uid)
+        else:
+            print("%d: rank %d/%d, value %g, percentile %.2f" % (
+                uid, rank, index.count(args.metric), index.value(args.metric, uid), index.percentile(args.metric, uid)))
+    if args.value_at is not None:
+        print("p%g: %s" % (args.value_at, index.value_at(args.metric, args.value_at)))
+
+
+if __name__ == '__main__':
+    main()
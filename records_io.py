@@ -0,0 +1,297 @@
+import os, re, shutil
+import time
+import math
+import json
+import numpy as np
+import pandas as pd
+
+# Record tables like a.json and ../P/<uid>.json. The writer streams a frame
+# in row chunks into a temp file next to the target and renames it over the
+# target on close, so readers never see a truncated file. JSON arrays are
+# byte for byte DataFrame.to_json(orient='records'), a .jsonl path holds one
+# record per line instead.
+#
+# Next to a table a columnar sidecar can be written, <path>.cols/ with one
+# file per column (.npy for numbers, a JSON list otherwise) and meta.json
+# holding the size and mtime of the table it was written for. Readers that
+# only need a few columns load just those files; a missing or stale sidecar
+# falls back to parsing the table.
+
+BACKUP_FORMAT = "%Y-%m-%d-%H-%M-%S"
+_BACKUP_NAME = re.compile(r'^\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}$')
+
+
+def is_lines(path):
+    return path.endswith('.jsonl')
+
+
+def read_records(path):
+    return pd.read_json(path, orient='records', encoding='utf-8', lines=is_lines(path))
+
+
+_SEPARATORS = ' \n\r\t[],'
+_decoder = json.JSONDecoder()
+
+
+def iter_records(path, columns=None, chunk_size=1 << 20):
+    # One dict per record without building a frame, read in chunks so only
+    # the current chunk is in memory. Works for JSON arrays and JSON Lines.
+    keep = None if columns is None else set(columns)
+    with open(path, 'r', encoding='utf-8') as f:
+        buf, pos, eof = '', 0, False
+        while True:
+            while pos < len(buf) and buf[pos] in _SEPARATORS:
+                pos += 1
+            if pos >= len(buf):
+                buf, pos = f.read(chunk_size), 0
+                if not buf:
+                    return
+                continue
+            try:
+                record, pos = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # A record cut at the end of the chunk, unless the file ended
+                if eof:
+                    raise
+                more = f.read(chunk_size)
+                eof = not more
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield record if keep is None else {k: v for k, v in record.items() if k in keep}
+
+
+def sidecar_path(path):
+    return path + '.cols'
+
+
+def _json_default(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+# The C encoder behind to_json(double_precision=10) prints floats below
+# 1e16 as the whole part and 10 rounded decimals, others with %.10g, and
+# read_json parses the text back as whole + decimals * _POW10[count]
+_JSON_PRECISION = 10
+_POW10 = [10.0 ** -n for n in range(16)]
+
+
+def _parse_json_float(text):
+    mantissa, _, exponent = text.partition('e')
+    whole, _, decimals = mantissa.partition('.')
+    value = float(whole) + float(decimals or 0) * _POW10[len(decimals)]
+    return value * math.pow(10.0, float(exponent)) if exponent else value
+
+
+def _json_round(values):
+    # Floats as they come back from to_json and read_json, without the
+    # round trip. Non finite values are written as null, so become NaN.
+    values = np.asarray(values, dtype=np.float64)
+    magnitude = np.abs(values)
+    with np.errstate(invalid='ignore'):
+        whole = np.floor(magnitude)
+        scaled = (magnitude - whole) * 10.0 ** _JSON_PRECISION
+        floor = np.floor(scaled)
+        half = scaled - floor
+    frac = np.nan_to_num(floor).astype(np.int64)
+    frac += (half > 0.5) | ((half == 0.5) & ((frac == 0) | (frac & 1 == 1)))
+    carry = frac >= 10 ** _JSON_PRECISION
+    whole += carry
+    frac[carry] = 0
+
+    # The decimals are printed without trailing zeros
+    count = np.full(values.shape, _JSON_PRECISION)
+    zeros = np.flatnonzero((frac % 10 == 0) & (frac > 0))
+    while zeros.shape[0]:
+        frac[zeros] //= 10
+        count[zeros] -= 1
+        zeros = zeros[frac[zeros] % 10 == 0]
+    count[frac == 0] = 1
+    rounded = (whole + frac * np.take(_POW10, count)) * np.where(values < 0, -1.0, 1.0)
+
+    exponential = (magnitude > 1e16 - 1) | ((magnitude != 0) & (magnitude < 1e-15))
+    for i in np.flatnonzero(exponential & np.isfinite(values)).tolist():
+        rounded[i] = _parse_json_float('%.*g' % (_JSON_PRECISION, magnitude[i])) * (-1.0 if values[i] < 0 else 1.0)
+    rounded[~np.isfinite(values)] = np.nan
+    return rounded
+
+
+def _json_column(values):
+    # A column of df as read_records would return it: numbers rounded like
+    # to_json, floats that all turn out whole become int64
+    if values.dtype.kind == 'f':
+        rounded = _json_round(values.to_numpy())
+        if rounded.shape[0] and np.isfinite(rounded).all() and (np.abs(rounded) < 2.0 ** 63).all():
+            as_int = rounded.astype(np.int64)
+            if (as_int == rounded).all():
+                return as_int
+        return rounded
+    if values.dtype.kind in 'iu':
+        return values.to_numpy(dtype=np.int64)
+    if values.dtype.kind == 'b':
+        return values.to_numpy()
+    return values.astype(object).where(values.notna(), None)
+
+
+def write_sidecar(path, df):
+    # Built from the frame just written, with the values and dtypes the JSON
+    # holds (bench_pipeline checks it against a parse of the table)
+    final_path = sidecar_path(path)
+    tmp_path = '%s.tmp-%d' % (final_path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    columns = []
+    # read_json finds no columns in an empty array
+    for i, name in enumerate(df.columns if df.shape[0] else []):
+        values = _json_column(df[name])
+        if isinstance(values, np.ndarray):
+            filename = 'c%04d.npy' % i
+            np.save(os.path.join(tmp_path, filename), values)
+        else:
+            filename = 'c%04d.json' % i
+            with open(os.path.join(tmp_path, filename), 'w', encoding='utf-8') as f:
+                json.dump(values.tolist(), f, ensure_ascii=False, default=_json_default)
+        columns.append({'name': str(name), 'file': filename, 'dtype': str(values.dtype)})
+
+    meta = {'rows': df.shape[0], 'columns': columns, 'source': source_stat(path)}
+    with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+    replace_dir(tmp_path, final_path)
+
+
+def source_stat(path):
+    st = os.stat(path)
+    return {'mtime': st.st_mtime_ns, 'size': st.st_size}
+
+
+def replace_dir(tmp_path, final_path):
+    # Swaps a finished directory in, readers briefly find none and fall back
+    old_path = '%s.old-%d' % (final_path, os.getpid())
+    if os.path.exists(final_path):
+        os.rename(final_path, old_path)
+    os.rename(tmp_path, final_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def load_sidecar(path):
+    try:
+        with open(os.path.join(sidecar_path(path), 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        source = source_stat(path)
+    except (OSError, ValueError):
+        return None
+    if meta['source'] != source:
+        return None
+    return meta
+
+
+def read_columns(path, columns=None):
+    # Only the requested columns, in that order. Columns the table does not
+    # have are left out, like missing keys in the records.
+    meta = load_sidecar(path)
+    if meta is None:
+        df = read_records(path)
+        return df if columns is None else df.loc[:, [c for c in columns if c in df.columns]]
+
+    files = {entry['name']: entry for entry in meta['columns']}
+    names = list(files) if columns is None else [c for c in columns if c in files]
+    data = {}
+    for name in names:
+        column_path = os.path.join(sidecar_path(path), files[name]['file'])
+        if column_path.endswith('.npy'):
+            data[name] = np.load(column_path)
+        else:
+            with open(column_path, 'r', encoding='utf-8') as f:
+                data[name] = pd.Series(json.load(f), dtype=files[name]['dtype'])
+    return pd.DataFrame(data, index=pd.RangeIndex(meta['rows']), columns=names)
+
+
+class RecordsWriter:
+    def __init__(self, path, lines=None, fsync=True):
+        self.path = path
+        self.lines = is_lines(path) if lines is None else lines
+        self.fsync = fsync
+        self.tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        self.f = open(self.tmp_path, 'w', encoding='utf-8')
+        self.count = 0
+        if not self.lines:
+            self.f.write('[')
+
+    def write_frame(self, df, chunk_rows=10000):
+        for start in range(0, df.shape[0], chunk_rows):
+            chunk = df.iloc[start:start+chunk_rows]
+            s = chunk.to_json(orient='records', lines=self.lines)
+            if self.lines:
+                self.f.write(s.rstrip('\n'))
+                self.f.write('\n')
+            else:
+                if self.count:
+                    self.f.write(',')
+                self.f.write(s[1:-1])
+            self.count += chunk.shape[0]
+
+    def close(self):
+        if not self.lines:
+            self.f.write(']')
+        self.f.flush()
+        if self.fsync:
+            os.fsync(self.f.fileno())
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_records(path, df, lines=None, fsync=True, sidecar=False):
+    with RecordsWriter(path, lines=lines, fsync=fsync) as writer:
+        writer.write_frame(df)
+    if sidecar:
+        write_sidecar(path, df)
+
+
+def list_backups(directory, ext):
+    names = []
+    for filename in os.listdir(directory):
+        basename, extname = os.path.splitext(filename)
+        if extname == ext and _BACKUP_NAME.match(basename):
+            names.append(filename)
+    return sorted(names)
+
+
+def backup(path, directory='.', keep=None):
+    # A hard link under a timestamped name: RecordsWriter replaces path by a
+    # rename, so the link keeps the old contents without copying them. Only
+    # the newest `keep` backups are kept.
+    if not os.path.exists(path):
+        return None
+    ext = os.path.splitext(path)[1]
+    dstname = os.path.join(directory, time.strftime(BACKUP_FORMAT) + ext)
+    if os.path.exists(dstname):
+        os.remove(dstname)
+    try:
+        os.link(path, dstname)
+    except OSError:
+        shutil.copyfile(path, dstname)
+
+    if keep is not None:
+        backups = list_backups(directory, ext)
+        for filename in backups[:max(0, len(backups) - keep)]:
+            os.remove(os.path.join(directory, filename))
+    return dstname
@@ -0,0 +1,51 @@
+import os
+import fcntl
+
+# One lock for every nightly job: the scheduler and the Timer loops that
+# archive_up_records, dataminer and predictor still run on their own all
+# take it, so a stage started by hand never overlaps a scheduled one.
+
+LOCK_PATH = 'scheduler.lock'
+
+g_lock_fd = None
+
+def acquire_lock(path=LOCK_PATH):
+    # An exclusive flock on the lock file, the kernel drops it when the
+    # holder exits so a crashed run leaves nothing to clean up. The file
+    # keeps the pid of the holder for whoever looks at it.
+    global g_lock_fd
+    fd = os.open(path, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    g_lock_fd = fd
+    return True
+
+
+def release_lock():
+    # The file stays: removing it would let a run that opened it just
+    # before lock the unlinked copy while another creates a new one
+    global g_lock_fd
+    if g_lock_fd is None:
+        return
+    os.ftruncate(g_lock_fd, 0)
+    fcntl.flock(g_lock_fd, fcntl.LOCK_UN)
+    os.close(g_lock_fd)
+    g_lock_fd = None
+
+
+def run_locked(function, log):
+    # Runs function under the lock, or logs and skips it while another run
+    # holds it. Returns whether it ran.
+    if not acquire_lock():
+        log("Another run is still in progress, skipped")
+        return False
+    try:
+        function()
+    finally:
+        release_lock()
+    return True
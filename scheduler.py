@@ -0,0 +1,179 @@
+import os
+import time
+import datetime
+import json
+import argparse
+from threading import Timer
+import archive_up_records
+import dataminer
+import predictor
+import avatars
+from instrument import Logger, Metrics, profile_run
+from run_lock import acquire_lock, release_lock
+
+# One nightly run of archive -> mine -> predict. Every stage starts as soon
+# as the stages it depends on have finished, a failed stage skips everything
+# downstream of it. The run lock keeps it from overlapping another run,
+# including the stand-alone loops of the stage scripts.
+
+STAGES_PATH = 'stages.jsonl'
+
+g_log = Logger('scheduler.log')
+
+def write_log(s, verbose=True):
+    g_log(s, verbose)
+
+
+def run_archive():
+    archive_up_records.archive_worker(incremental=archive_up_records.g_incremental)
+
+def run_mine():
+    dataminer.mining_worker()
+
+def run_predict():
+    predictor.predict_worker()
+
+def run_avatars():
+    avatars.avatar_worker()
+
+# name: (function, dependencies)
+STAGES = {
+    'archive': (run_archive, ()),
+    'mine': (run_mine, ('archive',)),
+    'predict': (run_predict, ('mine',)),
+}
+
+# Needs network access, only scheduled with --avatars
+AVATAR_STAGE = (run_avatars, ())
+
+
+def stage_order(stages):
+    order, visiting, done = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError("Stage dependency cycle at %s" % name)
+        visiting.add(name)
+        for dependency in stages[name][1]:
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+
+def run_stages(stages=STAGES):
+    if not acquire_lock():
+        write_log("Another run is still in progress, skipped")
+        return None
+
+    results = {}
+    metrics = Metrics('scheduler')
+    try:
+        run_start = time.time()
+        for name in stage_order(stages):
+            function, dependencies = stages[name]
+            blocked = [d for d in dependencies if results[d]['status'] != 'ok']
+            if blocked:
+                results[name] = {'status': 'skipped', 'seconds': 0.0}
+                write_log("Stage %s skipped, %s did not finish" % (name, ', '.join(blocked)))
+                continue
+
+            write_log("Stage %s started" % name)
+            start = time.perf_counter()
+            try:
+                function()
+                status = 'ok'
+            except Exception as e:
+                status = 'failed'
+                write_log("Stage %s failed: %s: %s" % (name, type(e).__name__, e))
+            seconds = time.perf_counter() - start
+            results[name] = {'status': status, 'seconds': round(seconds, 3)}
+            metrics.observe('stage', seconds, stage=name)
+            metrics.count('stages', stage=name, status=status)
+            write_log("Stage %s %s in %.1fs" % (name, 'finished' if status == 'ok' else 'failed', seconds))
+
+        record = {
+            'start': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run_start)),
+            'seconds': round(time.time() - run_start, 3),
+            'stages': results,
+        }
+        with open(STAGES_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+        metrics.write('scheduler.prom')
+    finally:
+        release_lock()
+        g_log.flush()
+    return results
+
+
+g_invoke_first = False
+g_start_hour = 2
+
+def on_timeout():
+    global g_invoke_first
+    if g_invoke_first:
+        run_stages()
+    g_invoke_first = True
+
+    now = datetime.datetime.now()
+    start_hour = g_start_hour
+    if now.timetuple().tm_hour > start_hour:
+        tomorrow = now + datetime.timedelta(days=1)
+        next_time = tomorrow.replace(hour=start_hour, minute=30, second=0)
+    else:
+        next_time = now.replace(hour=start_hour, minute=0, second=0)
+    interval = (next_time-now).seconds
+    write_log("Next execution %d seconds later" % interval)
+    g_log.flush()
+
+    timer = Timer(interval, on_timeout)
+    timer.start()
+
+
+def main(argv=None, prog=None):
+    global g_invoke_first, g_start_hour
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('--now', action='store_true', help='run immediately first')
+    parser.add_argument('--start-hour', type=int, default=2, help='hour of the nightly run')
+    parser.add_argument('--incremental', action='store_true', help='only archive new or changed snapshots')
+    parser.add_argument('--store', help='archive into and read from this series store instead of ../A')
+    parser.add_argument('--full', action='store_true', help='recompute every uploader instead of reusing the mining cache')
+    parser.add_argument('--jsonl', action='store_true', help='pass the mined uploaders as a.jsonl instead of a.json')
+    parser.add_argument('--avatars', action='store_true', help='also refresh the avatar cache for export_face')
+    parser.add_argument('--profile', help='run once under cProfile and dump the stats to this file')
+    parser.add_argument('--workers', type=int, default=1, help='number of mining processes')
+    parser.add_argument('--seed', type=int, help='seed the forecast random walk')
+    parser.add_argument('--paths', type=int, default=1, help='simulate this many paths per uploader and write percentile bands')
+    args = parser.parse_args(argv)
+
+    g_invoke_first = args.now
+    g_start_hour = args.start_hour
+    archive_up_records.g_incremental = args.incremental
+    dataminer.g_workers = max(1, args.workers)
+    dataminer.g_full = args.full
+    if args.jsonl:
+        dataminer.g_output_path = predictor.g_records_path = 'a.jsonl'
+    predictor.g_seed = args.seed
+    predictor.g_paths = max(1, args.paths)
+    if args.store:
+        archive_up_records.g_series_store = args.store
+        dataminer.g_series_path = args.store
+        predictor.g_series_path = args.store
+
+    if args.avatars:
+        STAGES['avatars'] = AVATAR_STAGE
+
+    if args.profile:
+        profile_run(run_stages, args.profile)
+        return
+    on_timeout()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+import sys, os, shutil
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+from timestamps import to_timestamps, DATETIME_FORMAT
+
+# Per-uploader time series, either one CSV per uid (../A/<uid>.csv) or a
+# columnar store: every column is one flat float64 file holding all series
+# back to back, ordered by uid and then by Time, plus a sorted uid index with
+# row offsets. Reads are zero-copy slices of memory-mapped files.
+#
+# <store>/CURRENT           name of the live generation
+# <store>/gen-NNNNNN/       uid.i64, offsets.i64, <column>.f64, meta.json
+#                           and checksum.u64, a content hash per uid
+#
+# Writers build a new generation and switch CURRENT atomically, readers keep
+# the generation they opened.
+#
+# A CSV directory gets such a store as a cache of its parsed series, see
+# refresh_cache.
+
+SERIES_COLUMNS = ('Time', 'PlayNum', 'FanNum', 'ChargeNum')
+
+
+def _map(path, dtype, length):
+    if length == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(length,))
+
+
+def series_checksum(columns):
+    # 64 bit content hash of one series as written, equal series get the
+    # same checksum in every generation
+    h = hashlib.blake2b(digest_size=8)
+    for c, values in columns:
+        h.update(c.encode())
+        h.update(np.ascontiguousarray(values).tobytes())
+    return int.from_bytes(h.digest(), 'little')
+
+
+def merge_series(parts):
+    # Concatenate, sort by Time and keep the last row for a repeated Time
+    parts = [p for p in parts if p['Time'].shape[0] > 0]
+    if not parts:
+        return {c: np.empty(0) for c in SERIES_COLUMNS}
+    merged = {c: np.concatenate([p[c] for p in parts]) for c in SERIES_COLUMNS}
+    order = np.argsort(merged['Time'], kind='stable')
+    t = merged['Time'][order]
+    keep = np.ones(t.shape[0], dtype=bool)
+    keep[:-1] = t[1:] != t[:-1]
+    order = order[keep]
+    return {c: merged[c][order] for c in SERIES_COLUMNS}
+
+
+def frame_to_series(df):
+    series = {'Time': to_timestamps(df['Time'])}
+    for c in SERIES_COLUMNS[1:]:
+        series[c] = pd.to_numeric(df[c], errors='coerce').to_numpy(dtype=np.float64)
+    return series
+
+
+def series_to_frame(series, uid=None):
+    df = pd.DataFrame({c: series[c] for c in SERIES_COLUMNS}, copy=False)
+    if uid is not None:
+        df.insert(0, 'uid', uid)
+    return df
+
+
+class SeriesStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'CURRENT'), 'r', encoding='utf-8') as f:
+            self.generation = f.read().strip()
+        gen_path = os.path.join(path, self.generation)
+        with open(os.path.join(gen_path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+
+        rows, uploaders = self.meta['rows'], self.meta['uploaders']
+        self.uid = _map(os.path.join(gen_path, 'uid.i64'), np.int64, uploaders)
+        self.offsets = _map(os.path.join(gen_path, 'offsets.i64'), np.int64, uploaders+1)
+        self.columns = {
+            c: _map(os.path.join(gen_path, c + '.f64'), np.float64, rows)
+            for c in self.meta['columns']
+        }
+        # Generations written before checksums were kept have none
+        checksum_path = os.path.join(gen_path, 'checksum.u64')
+        self.checksums = _map(checksum_path, np.uint64, uploaders) if os.path.exists(checksum_path) else None
+
+    def __len__(self):
+        return self.uid.shape[0]
+
+    def __contains__(self, uid):
+        i = np.searchsorted(self.uid, uid)
+        return i < self.uid.shape[0] and self.uid[i] == uid
+
+    def uids(self):
+        return self.uid.tolist()
+
+    def _index(self, uid):
+        i = np.searchsorted(self.uid, uid)
+        if i >= self.uid.shape[0] or self.uid[i] != uid:
+            raise KeyError(uid)
+        return i
+
+    def span(self, uid):
+        i = self._index(uid)
+        return int(self.offsets[i]), int(self.offsets[i+1])
+
+    def checksum(self, uid):
+        # The checksum written with the series, None without one
+        if self.checksums is None:
+            return None
+        return int(self.checksums[self._index(uid)])
+
+    def read(self, uid):
+        start, stop = self.span(uid)
+        return {c: col[start:stop] for c, col in self.columns.items()}
+
+    def read_frame(self, uid):
+        return series_to_frame(self.read(uid))
+
+    def fingerprint(self, uid):
+        # Content hash, a new generation leaves unchanged series unchanged.
+        # Looked up, only old generations hash the series here.
+        if uid not in self:
+            return None
+        checksum = self.checksum(uid)
+        if checksum is None:
+            checksum = series_checksum(self.read(uid).items())
+        return '%016x' % checksum
+
+    def items(self):
+        for i, uid in enumerate(self.uid.tolist()):
+            start, stop = int(self.offsets[i]), int(self.offsets[i+1])
+            yield uid, {c: col[start:stop] for c, col in self.columns.items()}
+
+
+class SeriesStoreWriter:
+    def __init__(self, path, keep_generations=2):
+        self.path = path
+        self.keep_generations = keep_generations
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        generations = self.generations()
+        number = int(generations[-1].split('-')[1]) + 1 if generations else 1
+        self.generation = 'gen-%06d' % number
+        self.gen_path = os.path.join(path, self.generation)
+        os.mkdir(self.gen_path)
+
+        self.files = {c: open(os.path.join(self.gen_path, c + '.f64'), 'wb') for c in SERIES_COLUMNS}
+        self.uid = []
+        self.offsets = [0]
+        self.checksums = []
+
+    def generations(self):
+        return sorted(name for name in os.listdir(self.path) if name.startswith('gen-'))
+
+    def append(self, uid, series, checksum=None):
+        # checksum: the series_checksum of series when already known
+        uid = int(uid)
+        if self.uid and uid <= self.uid[-1]:
+            raise ValueError("uids must be appended in increasing order: %d after %d" % (uid, self.uid[-1]))
+
+        order = np.argsort(series['Time'], kind='stable')
+        columns = [(c, np.asarray(series[c], dtype=np.float64)[order]) for c in SERIES_COLUMNS]
+        for c, values in columns:
+            values.tofile(self.files[c])
+        self.uid.append(uid)
+        self.offsets.append(self.offsets[-1] + order.shape[0])
+        self.checksums.append(series_checksum(columns) if checksum is None else checksum)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        np.array(self.uid, dtype=np.int64).tofile(os.path.join(self.gen_path, 'uid.i64'))
+        np.array(self.offsets, dtype=np.int64).tofile(os.path.join(self.gen_path, 'offsets.i64'))
+        np.array(self.checksums, dtype=np.uint64).tofile(os.path.join(self.gen_path, 'checksum.u64'))
+        meta = {'columns': list(SERIES_COLUMNS), 'rows': self.offsets[-1], 'uploaders': len(self.uid)}
+        with open(os.path.join(self.gen_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+        tmp_path = os.path.join(self.path, 'CURRENT.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.generation)
+        os.replace(tmp_path, os.path.join(self.path, 'CURRENT'))
+
+        for name in self.generations()[:-self.keep_generations]:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.gen_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CsvSeries:
+    def __init__(self, path):
+        self.path = path
+
+    def uids(self):
+        uids = []
+        for filename in os.listdir(self.path):
+            basename, extname = os.path.splitext(filename)
+            if basename.startswith('.'): continue
+            if extname.lower() != '.csv': continue
+            try:
+                uids.append(int(basename))
+            except ValueError:
+                continue
+        return sorted(uids)
+
+    def __contains__(self, uid):
+        return os.path.exists(os.path.join(self.path, str(uid)+'.csv'))
+
+    def fingerprint(self, uid):
+        try:
+            st = os.stat(os.path.join(self.path, str(uid)+'.csv'))
+        except FileNotFoundError:
+            return None
+        return '%d:%d' % (st.st_mtime_ns, st.st_size)
+
+    def read_frame(self, uid):
+        df = pd.read_csv(os.path.join(self.path, str(uid)+'.csv'))
+        df['Time'] = to_timestamps(df['Time'])
+        return df
+
+    def read(self, uid):
+        return frame_to_series(self.read_frame(uid))
+
+    def items(self):
+        for uid in self.uids():
+            yield uid, self.read(uid)
+
+
+def is_store(path):
+    return os.path.exists(os.path.join(path, 'CURRENT'))
+
+
+# Parsed copies of the CSV series, kept as a store in <csv dir>/.cache so a
+# night's stages parse every CSV once. Each generation records the mtime and
+# size of the CSVs it was built from, a CSV that changed is parsed again on
+# the next refresh and the others are copied over from the last generation.
+
+def cache_path(csv_path):
+    return os.path.join(csv_path, '.cache')
+
+
+def load_fingerprints(store):
+    try:
+        with open(os.path.join(store.path, store.generation, 'fingerprints.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def refresh_cache(csv_path):
+    source = CsvSeries(csv_path)
+    path = cache_path(csv_path)
+    current = {str(uid): source.fingerprint(uid) for uid in source.uids()}
+
+    old = SeriesStore(path) if is_store(path) else None
+    old_prints = load_fingerprints(old) if old is not None else {}
+    if old is not None and old_prints == current:
+        return old
+
+    prints = {}
+    with SeriesStoreWriter(path) as writer:
+        for key, fingerprint in current.items():
+            uid = int(key)
+            checksum = None
+            if old_prints.get(key) == fingerprint and uid in old:
+                series = old.read(uid)
+                checksum = old.checksum(uid)
+            else:
+                try:
+                    series = source.read(uid)
+                except Exception:
+                    # Left out, readers fall back to the CSV and its error
+                    continue
+            writer.append(uid, series, checksum)
+            prints[key] = fingerprint
+        with open(os.path.join(writer.gen_path, 'fingerprints.json'), 'w', encoding='utf-8') as f:
+            json.dump(prints, f)
+    return SeriesStore(path)
+
+
+class CachedCsvSeries:
+    # CsvSeries served from the cache, uids the cache lacks go to the CSV
+    def __init__(self, path):
+        self.path = path
+        self.csv = CsvSeries(path)
+        self.cache = refresh_cache(path)
+
+    def uids(self):
+        return self.csv.uids()
+
+    def __contains__(self, uid):
+        return uid in self.csv
+
+    def fingerprint(self, uid):
+        return self.csv.fingerprint(uid)
+
+    def read(self, uid):
+        if uid in self.cache:
+            return self.cache.read(uid)
+        return self.csv.read(uid)
+
+    def read_frame(self, uid):
+        if uid in self.cache:
+            return self.cache.read_frame(uid)
+        return self.csv.read_frame(uid)
+
+    def items(self):
+        for uid in self.uids():
+            yield uid, self.read(uid)
+
+
+def open_series(path, cache=True):
+    if is_store(path):
+        return SeriesStore(path)
+    if cache:
+        try:
+            return CachedCsvSeries(path)
+        except OSError:
+            pass
+    return CsvSeries(path)
+
+
+def import_csv_dir(src, dst):
+    source = CsvSeries(src)
+    with SeriesStoreWriter(dst) as writer:
+        for uid, series in source.items():
+            writer.append(uid, merge_series([series]))
+    return len(writer.uid)
+
+
+def export_csv_dir(src, dst):
+    if not os.path.exists(dst):
+        os.makedirs(dst)
+    count = 0
+    for uid, series in SeriesStore(src).items():
+        df = series_to_frame(series, uid)
+        df['Time'] = [time.strftime(DATETIME_FORMAT, time.localtime(t)) for t in series['Time'].tolist()]
+        df.to_csv(os.path.join(dst, str(uid)+'.csv'), index=False, float_format='%.15g')
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[1] not in ('import', 'export'):
+        print("Usage: %s import <csv dir> <store> | export <store> <csv dir>" % sys.argv[0])
+        exit()
+
+    if sys.argv[1] == 'import':
+        count = import_csv_dir(sys.argv[2], sys.argv[3])
+    else:
+        count = export_csv_dir(sys.argv[2], sys.argv[3])
+    print("Finished %sing %d uploaders." % (sys.argv[1], count))
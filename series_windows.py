@@ -0,0 +1,45 @@
+import numpy as np
+
+# Window aggregates over one uploader's time series sorted by Time. A window
+# holds the rows with Time > boundary, its edges are found by binary search
+# so no masked copy of the series is built. Rows with a NaN Time sort last
+# and belong to no window, like df.loc[df['Time'] > boundary].
+
+
+def sort_series(series):
+    # Series from the store are already sorted, only CSVs may need it
+    times = series['Time']
+    valid = times.shape[0] - np.count_nonzero(np.isnan(times))
+    if valid == 0:
+        # All NaN: no window gets a row whatever the order
+        return series
+    if not np.isnan(times[:valid]).any() and not (times[1:valid] < times[:valid-1]).any():
+        return series
+    order = np.argsort(times, kind='stable')
+    return {c: values[order] for c, values in series.items()}
+
+
+def window_edges(times, boundaries):
+    # First and one-past-last row of every window, first == stop when empty
+    stop = times.shape[0] - np.count_nonzero(np.isnan(times))
+    first = np.searchsorted(times[:stop], np.asarray(boundaries, dtype=np.float64), side='right')
+    return first, np.full(first.shape, stop)
+
+
+def window_stats(series, windows, columns):
+    # windows maps a name to its boundary, every window gets the row count
+    # and first, last and delta (last - first) of each column. Empty windows
+    # only get a zero count.
+    series = sort_series(series)
+    names = list(windows)
+    first, stop = window_edges(series['Time'], [windows[name] for name in names])
+
+    stats = {}
+    for name, i, j in zip(names, first.tolist(), stop.tolist()):
+        window = {'count': j - i}
+        if j > i:
+            window['first'] = {c: series[c][i] for c in columns}
+            window['last'] = {c: series[c][j-1] for c in columns}
+            window['delta'] = {c: window['last'][c] - window['first'][c] for c in columns}
+        stats[name] = window
+    return stats
@@ -0,0 +1,35 @@
+import time
+import numpy as np
+import pandas as pd
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _local_offsets(naive):
+    # mktime offset for every distinct wall-clock hour, so DST is honoured
+    # like time.mktime(time.strptime(...)) without a call per row. Only the
+    # repeated hour at the end of DST is ambiguous, mktime itself resolves it
+    # depending on its previous calls.
+    hours, inverse = np.unique(naive // 3600, return_inverse=True)
+    offsets = np.empty(hours.shape[0], dtype=np.float64)
+    for i, hour in enumerate(hours.tolist()):
+        t = hour * 3600
+        offsets[i] = t - time.mktime(time.gmtime(t)[:8] + (-1,))
+    return offsets[inverse.reshape(-1)]
+
+
+def to_timestamps(values, fmt=DATETIME_FORMAT):
+    values = values if isinstance(values, pd.Series) else pd.Series(values)
+    if values.dtype != object:
+        return values.to_numpy(dtype=np.float64)
+
+    # Epoch numbers pass through, only the strings are parsed
+    is_str = values.map(lambda v: isinstance(v, str)).to_numpy(dtype=bool)
+    out = np.empty(values.shape[0], dtype=np.float64)
+    if not is_str.all():
+        out[~is_str] = pd.to_numeric(values[~is_str], errors='coerce').to_numpy(dtype=np.float64)
+    if is_str.any():
+        dt = pd.to_datetime(values[is_str].str.strip(), format=fmt)
+        naive = dt.to_numpy(dtype='datetime64[s]').astype(np.int64)
+        out[is_str] = naive - _local_offsets(naive)
+    return out
@@ -0,0 +1,330 @@
+import os, shutil
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from index_engine import INDEX_OUTPUTS
+from records_io import read_columns, list_backups, replace_dir, BACKUP_FORMAT
+from instrument import Logger
+
+# Append-only history of the per-uploader metrics, one run per mining run:
+#
+# <store>/uids.i64          uid dictionary, a uid's code is its position
+# <store>/runs.jsonl        one line per run: run, time, dictionary size,
+#                           keyframe flag and the table it came from
+# <store>/r000042/          the columns of run 42, indexed by code
+#
+# Every g_keyframe_every runs a keyframe stores whole columns (<col>.f8).
+# The runs in between only store the codes whose value changed since the
+# run before (<col>.pos.i32, <col>.val.f8). The daily windows move the
+# metrics of nearly every uploader each night, so a delta is about as long
+# as the dictionary: all of them are memory mapped and a uid's history
+# costs a binary search per run and column, not a read of every delta.
+# The 'present' column tells which uids the run's table listed, NaN is a
+# value like any other. A run becomes visible when its line is appended to
+# runs.jsonl, after its files are written.
+
+TREND_COLUMNS = (
+    'PlayNum', 'FanNum', 'ChargeNum', 'ViewsMonthly', 'ChargesMonthly', 'AvgView', 'AvgScore'
+) + INDEX_OUTPUTS
+PRESENT = 'present'
+
+g_trend_path = 'trends'
+g_keyframe_every = 16
+
+g_log = Logger('trend_store.log')
+
+def write_log(s, verbose=True):
+    g_log(s, verbose)
+
+
+def _same(a, b):
+    return (a == b) | (np.isnan(a) & np.isnan(b))
+
+
+class TrendStore:
+    def __init__(self, path=None):
+        self.path = g_trend_path if path is None else path
+        self.meta = self._read_runs()
+        self.columns = {}
+        self.dictionary = None
+        self.order = None
+
+    def _read_runs(self):
+        # self.runs_size is the length of the complete lines, what follows
+        # is cut off before the next run is appended
+        runs = []
+        self.runs_size = 0
+        try:
+            with open(os.path.join(self.path, 'runs.jsonl'), 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        runs.append(json.loads(line))
+                    except ValueError:
+                        # A line cut short by a crash, the run never finished
+                        break
+                    self.runs_size += len(line)
+        except FileNotFoundError:
+            pass
+        return runs
+
+    def runs(self):
+        return pd.DataFrame(self.meta, columns=['run', 'time', 'size', 'keyframe', 'source'])
+
+    def uids(self):
+        if not self.meta:
+            return np.empty(0, dtype=np.int64)
+        if self.dictionary is None or self.dictionary.shape[0] < self.meta[-1]['size']:
+            self.dictionary = np.fromfile(os.path.join(self.path, 'uids.i64'), dtype=np.int64)
+            self.order = None
+        return self.dictionary[:self.meta[-1]['size']]
+
+    def _codes(self, uids, values):
+        # Positions of values in the dictionary uids, -1 for unknown ones.
+        # The uid order of the dictionary is kept until it grows.
+        if uids.shape[0] == 0:
+            return np.full(np.shape(values), -1)
+        if self.order is None or self.order.shape[0] != uids.shape[0]:
+            self.order = np.argsort(uids, kind='stable')
+        i = np.searchsorted(uids, values, sorter=self.order)
+        codes = self.order[np.minimum(i, uids.shape[0] - 1)]
+        return np.where(uids[codes] == values, codes, -1)
+
+    def _run_path(self, run):
+        return os.path.join(self.path, 'r%06d' % run)
+
+    def _load(self, run, name):
+        key = (run, name)
+        if key not in self.columns:
+            base = os.path.join(self._run_path(run), name)
+            if self.meta[run]['keyframe']:
+                self.columns[key] = np.memmap(base + '.f8', dtype=np.float64, mode='r') if self.meta[run]['size'] else np.empty(0)
+            elif self.meta[run]['stored'][name]:
+                self.columns[key] = (np.memmap(base + '.pos.i32', dtype=np.int32, mode='r'),
+                                     np.memmap(base + '.val.f8', dtype=np.float64, mode='r'))
+            else:
+                self.columns[key] = (np.empty(0, dtype=np.int32), np.empty(0))
+        return self.columns[key]
+
+    def _keyframe(self, run):
+        while not self.meta[run]['keyframe']:
+            run -= 1
+        return run
+
+    def _column(self, run, name):
+        # Whole column of a run: the keyframe with the changes after it applied
+        start = self._keyframe(run)
+        values = np.full(self.meta[run]['size'], np.nan)
+        keyframe = self._load(start, name)
+        values[:keyframe.shape[0]] = keyframe
+        for r in range(start + 1, run + 1):
+            positions, changed = self._load(r, name)
+            values[positions] = changed
+        return values
+
+    def append(self, df, when=None, source=None, columns=TREND_COLUMNS):
+        # Adds df (uid plus metric columns) as the next run, returns its number
+        if when is None:
+            when = time.time()
+        os.makedirs(self.path, exist_ok=True)
+        df = df.drop_duplicates('uid', keep='first')
+        run = len(self.meta)
+
+        # Entries past the last run's size were left by an unfinished append
+        uids = self.uids()
+        df_uids = df['uid'].to_numpy(dtype=np.int64)
+        new = df_uids[~np.isin(df_uids, uids)]
+        with open(os.path.join(self.path, 'uids.i64'), 'r+b' if run else 'wb') as f:
+            f.truncate(uids.nbytes)
+            f.seek(uids.nbytes)
+            f.write(new.tobytes())
+        uids = self.dictionary = np.concatenate([uids, new])
+        codes = self._codes(uids, df_uids)
+
+        keyframe = run % g_keyframe_every == 0
+        run_path = self._run_path(run)
+        shutil.rmtree(run_path, ignore_errors=True)
+        os.makedirs(run_path)
+        sizes = {}
+        for name in (PRESENT,) + tuple(columns):
+            values = np.full(uids.shape[0], np.nan if name != PRESENT else 0.0)
+            if name == PRESENT:
+                values[codes] = 1.0
+            elif name in df.columns:
+                values[codes] = pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=np.float64)
+            base = os.path.join(run_path, name)
+            if keyframe:
+                values.tofile(base + '.f8')
+                sizes[name] = values.shape[0]
+            else:
+                previous = self._column(run - 1, name) if name in self.meta[run-1]['columns'] else np.full(0, np.nan)
+                padded = np.full(uids.shape[0], np.nan)
+                padded[:previous.shape[0]] = previous
+                positions = np.flatnonzero(~_same(values, padded)).astype(np.int32)
+                positions.tofile(base + '.pos.i32')
+                values[positions].tofile(base + '.val.f8')
+                sizes[name] = positions.shape[0]
+
+        entry = {'run': run, 'time': when, 'size': int(uids.shape[0]), 'keyframe': keyframe,
+                 'source': source, 'columns': [PRESENT] + list(columns), 'stored': sizes}
+        line = (json.dumps(entry) + '\n').encode('utf-8')
+        with open(os.path.join(self.path, 'runs.jsonl'), 'ab') as f:
+            f.truncate(self.runs_size)
+            f.write(line)
+        self.runs_size += len(line)
+        self.meta.append(entry)
+        return run
+
+    def read_run(self, run=-1, columns=TREND_COLUMNS):
+        # Cross-section of one run: the uids its table listed and their values
+        run = range(len(self.meta))[run]
+        present = self._column(run, PRESENT) == 1.0
+        data = {'uid': self.uids()[:self.meta[run]['size']][present]}
+        for name in columns:
+            if name in self.meta[run]['columns']:
+                data[name] = self._column(run, name)[present]
+        return pd.DataFrame(data)
+
+    def read_uid(self, uid, columns=TREND_COLUMNS, start=None, end=None):
+        # History of one uid over the runs with start <= time < end, indexed
+        # by the run time (unix seconds). Walks forward from the keyframe
+        # before start, so only the changes of those runs are looked at.
+        code = int(self._codes(self.uids(), np.array([uid], dtype=np.int64))[0])
+        runs = [m['run'] for m in self.meta
+                if (start is None or m['time'] >= start) and (end is None or m['time'] < end)]
+        if code < 0 or not runs:
+            return pd.DataFrame(columns=list(columns), index=pd.Index([], name='time'))
+
+        names = (PRESENT,) + tuple(columns)
+        state = dict.fromkeys(names, np.nan)
+        rows, times = [], []
+        for run in range(self._keyframe(runs[0]), runs[-1] + 1):
+            meta = self.meta[run]
+            for name in names:
+                if name not in meta['columns']:
+                    state[name] = np.nan
+                elif code >= meta['size']:
+                    pass
+                elif meta['keyframe']:
+                    state[name] = float(self._load(run, name)[code])
+                else:
+                    positions, changed = self._load(run, name)
+                    i = np.searchsorted(positions, code)
+                    if i < positions.shape[0] and positions[i] == code:
+                        state[name] = float(changed[i])
+            if run >= runs[0] and state[PRESENT] == 1.0:
+                rows.append([state[name] for name in columns])
+                times.append(meta['time'])
+        return pd.DataFrame(rows, columns=list(columns), index=pd.Index(times, name='time'))
+
+
+def append_table(path, store=None, when=None):
+    # The table as written, so a run matches the JSON like a migrated snapshot
+    df = read_columns(path, ('uid',) + TREND_COLUMNS)
+    return TrendStore(store).append(df, when=when, source=os.path.basename(path))
+
+
+def backup_time(filename):
+    # Unix time in the name of a timestamped backup, None for other names
+    try:
+        return time.mktime(time.strptime(os.path.splitext(filename)[0], BACKUP_FORMAT))
+    except ValueError:
+        return None
+
+
+def import_snapshots(directory, store=None, remove=False):
+    # Imports the timestamped a.json backups, oldest first. A backup taken
+    # after a mined run holds that run's table, so those are skipped, as are
+    # backups imported before. When a backup is older than the last run the
+    # store is rebuilt with the runs in time order and swapped in, otherwise
+    # the backups are appended. With remove the imported backups are deleted
+    # afterwards.
+    trends = TrendStore(store)
+    sources = {m['source'] for m in trends.meta}
+    mined = [m['time'] for m in trends.meta if backup_time(m['source'] or '') is None]
+    first_mined = min(mined) if mined else None
+
+    pending = []
+    for filename in list_backups(directory, '.json'):
+        when = backup_time(filename)
+        if filename in sources:
+            continue
+        if first_mined is not None and when > first_mined:
+            write_log("Skipped %s, its table is already in the store" % filename, verbose=False)
+            continue
+        pending.append((when, filename))
+    if not pending:
+        write_log("Nothing to import from %s" % directory)
+        return 0
+
+    def load(filename):
+        return read_columns(os.path.join(directory, filename), ('uid',) + TREND_COLUMNS)
+
+    if trends.meta and pending[0][0] < trends.meta[-1]['time']:
+        # Older history goes in front of the runs already stored
+        tmp_path = '%s.tmp-%d' % (trends.path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        rebuilt = TrendStore(tmp_path)
+        items = [(m['time'], 0, m) for m in trends.meta] + [(when, 1, filename) for when, filename in pending]
+        for when, imported, item in sorted(items, key=lambda item: item[:2]):
+            if imported:
+                rebuilt.append(load(item), when=when, source=item)
+            else:
+                columns = tuple(c for c in item['columns'] if c != PRESENT)
+                rebuilt.append(trends.read_run(item['run'], columns), when=when, source=item['source'], columns=columns)
+        replace_dir(tmp_path, trends.path)
+        write_log("Rebuilt %s with %d imported snapshots in front of %d runs" % (trends.path, len(pending), len(trends.meta)))
+    else:
+        for when, filename in pending:
+            run = trends.append(load(filename), when=when, source=filename)
+            write_log("Imported %s as run %d" % (filename, run))
+
+    if remove:
+        for _, filename in pending:
+            os.remove(os.path.join(directory, filename))
+    write_log("Imported %d snapshots" % len(pending))
+    return len(pending)
+
+
+def store_size(path):
+    total = 0
+    for root, _, filenames in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in filenames)
+    return total
+
+
+def main(argv=None, prog=None):
+    global g_keyframe_every
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('--store', default=g_trend_path, help='trend store directory')
+    parser.add_argument('--import', dest='import_dir', help='import the timestamped snapshots in this directory')
+    parser.add_argument('--remove', action='store_true', help='delete snapshots once imported')
+    parser.add_argument('--keyframe-every', type=int, default=g_keyframe_every, help='runs between full copies of the columns')
+    parser.add_argument('--uid', type=int, help='print the history of this uploader')
+    parser.add_argument('--run', type=int, help='print the uploaders of this run, -1 for the last')
+    parser.add_argument('--columns', default='FanNum,WorkIndex,SummaryIndex,ChannelValue', help='comma separated columns to print')
+    args = parser.parse_args(argv)
+
+    g_keyframe_every = max(1, args.keyframe_every)
+    columns = tuple(args.columns.split(','))
+    if args.import_dir:
+        import_snapshots(args.import_dir, args.store, args.remove)
+        print("Store size %d bytes" % store_size(args.store))
+    trends = TrendStore(args.store)
+    if args.uid is not None:
+        history = trends.read_uid(args.uid, columns)
+        history.index = pd.to_datetime(history.index, unit='s')
+        print(history.to_string())
+    if args.run is not None:
+        print(trends.read_run(args.run, columns).to_string(index=False))
+    if args.uid is None and args.run is None and not args.import_dir:
+        runs = trends.runs()
+        runs['time'] = pd.to_datetime(runs['time'], unit='s')
+        print(runs.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
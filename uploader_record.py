@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+# Fixed schema of what compute_index mines per uploader, in the column order
+# of a.json. PlayNum, FanNum and ChargeNum are also in ../Apic/a.json and
+# are overwritten when the series has newer values.
+MINED_FIELDS = (
+    'ViewsFirstDayInMonth', 'ViewsMonthly', 'ChargesMonthly', 'ChargeNum'
+    , 'ViewsWeekAgo', 'ViewsNow', 'ViewsWeekly', 'PlayNum'
+    , 'FansWeekAgo', 'FansNow', 'FanIncWeekly', 'FanNum'
+    , 'RecentSince', 'RecentCount', 'AvgView', 'AvgScore', 'AvgQuality'
+    , 'AvgDuration', 'TotalCount', 'Frequency'
+)
+
+
+class UploaderRecord:
+    # What one compute_index call mined. A field it did not get to (no
+    # series this month, a failed history parse) stays unset rather than
+    # NaN, like a key missing from the old per-uid Series.
+    __slots__ = ('uid',) + MINED_FIELDS
+
+    def __init__(self, uid):
+        self.uid = uid
+
+    def fields(self):
+        for name in MINED_FIELDS:
+            try:
+                yield name, getattr(self, name)
+            except AttributeError:
+                pass
+
+
+def _is_int(value):
+    return isinstance(value, (int, np.integer)) and not isinstance(value, (bool, np.bool_))
+
+
+class UploaderTable:
+    # Struct of arrays for the mined fields of every uploader, one float64
+    # column each, filled row by row and turned into a frame once. A column
+    # comes out as int64 when every row holds an integer, and float64 with
+    # NaN otherwise, which is what DataFrame(list of Series) inferred. A
+    # field no uploader got is left out of the frame, as it was then.
+    def __init__(self, df, fields=MINED_FIELDS):
+        self.df = df
+        self.fields = fields
+        self.values = np.full((len(fields), df.shape[0]), np.nan)
+        self.assigned = np.zeros((len(fields), df.shape[0]), dtype=bool)
+        self.integer = np.ones(len(fields), dtype=bool)
+        self.positions = {name: j for j, name in enumerate(fields)}
+
+    def put(self, i, record):
+        for name, value in record.fields():
+            j = self.positions[name]
+            self.values[j, i] = value
+            self.assigned[j, i] = True
+            if self.integer[j] and not _is_int(value):
+                self.integer[j] = False
+
+    def frame(self):
+        data = {}
+        for name in self.df.columns:
+            data[name] = self.df[name]
+        for j, name in enumerate(self.fields):
+            assigned = self.assigned[j]
+            if name in self.df.columns:
+                # Rows without a mined value keep the input one
+                base = self.df[name]
+                if base.dtype.kind in 'iu' and self.integer[j]:
+                    data[name] = pd.Series(np.where(assigned, self.values[j], base.to_numpy()).astype(np.int64),
+                                           index=self.df.index)
+                    continue
+                values = np.where(assigned, self.values[j], pd.to_numeric(base, errors='coerce').to_numpy(dtype=np.float64))
+            elif not assigned.any():
+                continue
+            else:
+                values = self.values[j]
+                if assigned.all() and self.integer[j]:
+                    values = values.astype(np.int64)
+            data[name] = pd.Series(values, index=self.df.index)
+        return pd.DataFrame(data, index=self.df.index)